@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the NHS technical test
+
+The real 2M-row import_data.csv is external to this repository, so this
+module generates synthetic row_id,postcode files of a configurable size
+(and proportion of invalid postcodes) and measures the code against them.
+
+Each benchmark is run in a child process so that measurements such as peak
+resident set size (RSS) aren't polluted by whatever ran before it.
+
+@author: Tim Greening-Jackson
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from itertools import compress
+
+from NHSPostCode import PCValidationCodes
+
+# Character classes taken from the specified RE (see NHSPostCode)
+
+AREA_FIRST     = "ABCDEFGHIJKLMNOPRSTUWYZ"             # [A-PR-UWYZ]
+AREA_SECOND    = "ABCDEFGHKLMNOPQRSTUVWXY"             # [A-HK-Y]
+A9A_LETTERS    = "ABCDEFGHJKPSTUW"                     # [A-HJKPSTUW]
+AA9A_LETTERS   = "ABEHMNPRVWXY"                        # [ABEHMNPRVWXY]
+INWARD_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"                # [ABD-HJLNP-UW-Z]
+DIGITS         = "0123456789"
+
+# ... and their complements, from which the invalid postcodes are made
+
+NOT_AREA_FIRST     = "QVX"
+NOT_AREA_SECOND    = "IJZ"
+NOT_A9A_LETTERS    = "ILMNOQRVXYZ"
+NOT_AA9A_LETTERS   = "CDFGIJKLOQSTUZ"
+NOT_INWARD_LETTERS = "CIKMOV"
+PUNCTUATION        = "!\"#$%&'()*+-./:;<=>?@[]^`{|}~£±"
+
+SINGLE_DIGIT_AREAS = "BR|FY|HA|HD|HG|HR|HS|HX|JE|LD|SM|SR|WC|WN|ZE".split("|")
+DOUBLE_DIGIT_AREAS = "AB|LL|SO".split("|")
+
+
+def RandomArea(rng, exclude=()):
+    """
+    Returns a random two letter postcode area not in exclude
+    """
+    while True:
+        area = rng.choice(AREA_FIRST) + rng.choice(AREA_SECOND)
+        if area not in exclude:
+            return area
+
+
+def RandomDistrict(rng):
+    """
+    Returns a random one or two digit district
+    """
+    return "".join(rng.choice(DIGITS) for i in range(rng.randint(1, 2)))
+
+
+def RandomInward(rng):
+    """
+    Returns a random inward part (e.g. 7EP) which validates against the specified RE
+    """
+    return rng.choice(DIGITS) + rng.choice(INWARD_LETTERS) + rng.choice(INWARD_LETTERS)
+
+
+def RandomValidPostCode(rng):
+    """
+    Returns a random postcode which validates against the specified RE. Each of
+    the outward shapes (A9, A99, AA9, AA99, A9A, AA9A and WC9A) is equally likely.
+    """
+    shape = rng.randrange(7)
+    if shape == 0:                                     # A9
+        outward = rng.choice(AREA_FIRST) + rng.choice(DIGITS)
+    elif shape == 1:                                   # A99
+        outward = rng.choice(AREA_FIRST) + rng.choice(DIGITS) + rng.choice(DIGITS)
+    elif shape == 2:                                   # AA9
+        outward = RandomArea(rng, DOUBLE_DIGIT_AREAS) + rng.choice(DIGITS)
+    elif shape == 3:                                   # AA99
+        outward = RandomArea(rng, SINGLE_DIGIT_AREAS) + rng.choice(DIGITS) + rng.choice(DIGITS)
+    elif shape == 4:                                   # A9A
+        outward = rng.choice(AREA_FIRST) + rng.choice(DIGITS) + rng.choice(A9A_LETTERS)
+    elif shape == 5:                                   # AA9A
+        outward = RandomArea(rng) + rng.choice(DIGITS) + rng.choice(AA9A_LETTERS)
+    else:                                              # WC9A
+        outward = "WC" + rng.choice(DIGITS) + rng.choice(AA9A_LETTERS)
+    return "{} {}".format(outward, RandomInward(rng))
+
+
+# Each of the following returns a random postcode which fails to validate and
+# which PostCode.Analyse() puts down to the failure class of the same name
+
+def RandomJunk(rng):                                   # e.g. $%± ()()
+    return " ".join("".join(rng.choice(PUNCTUATION) for i in range(rng.randint(1, 4)))
+                    for group in range(2))
+
+def RandomIncorrectGrouping(rng):                      # e.g. LS44PL or LS4 4 PL
+    outward, inward = RandomValidPostCode(rng).split()
+    if rng.random() < 0.5:
+        return outward + inward
+    return "{} {} {}".format(outward, inward[0], inward[1:])
+
+def RandomInwardMalformed(rng):                        # e.g. XX XXX or A1 9A
+    outward = RandomValidPostCode(rng).split()[0]
+    inward  = rng.choice([rng.choice(DIGITS) + rng.choice(NOT_INWARD_LETTERS) + rng.choice(INWARD_LETTERS),
+                          rng.choice(INWARD_LETTERS) * 3,
+                          rng.choice(DIGITS) + rng.choice(INWARD_LETTERS)])
+    return "{} {}".format(outward, inward)
+
+def RandomOutwardMalformed(rng):                       # e.g. A9Q 9AA
+    outward = rng.choice([rng.choice(AREA_FIRST) + rng.choice(DIGITS) + rng.choice(NOT_A9A_LETTERS),
+                          rng.choice(DIGITS) + rng.choice(AREA_FIRST),
+                          RandomArea(rng) + rng.choice(AREA_FIRST) + rng.choice(DIGITS)])
+    return "{} {}".format(outward, RandomInward(rng))
+
+def RandomOutwardAA9AMalformed(rng):                   # e.g. AA9C 9AA
+    if rng.random() < 0.5:
+        outward = (RandomArea(rng, ["WC"]) + rng.choice(DIGITS) + rng.choice(NOT_AA9A_LETTERS))
+    else:
+        outward = (rng.choice(NOT_AREA_FIRST) + rng.choice(AREA_SECOND) + rng.choice(DIGITS) +
+                   rng.choice(AA9A_LETTERS))
+    return "{} {}".format(outward, RandomInward(rng))
+
+def RandomOutwardAA9Malformed(rng):                    # e.g. LI10 3QP
+    if rng.random() < 0.5:
+        area = rng.choice(NOT_AREA_FIRST) + rng.choice(AREA_SECOND)
+    else:
+        area = rng.choice(AREA_FIRST) + rng.choice(NOT_AREA_SECOND)
+    return "{}{} {}".format(area, RandomDistrict(rng), RandomInward(rng))
+
+def RandomOutwardA9Malformed(rng):                     # e.g. Q1 9AA
+    return "{}{} {}".format(rng.choice(NOT_AREA_FIRST), RandomDistrict(rng), RandomInward(rng))
+
+def RandomSingleDigitDistrict(rng):                    # e.g. FY10 4PL
+    return "{}{}{} {}".format(rng.choice(SINGLE_DIGIT_AREAS), rng.choice(DIGITS),
+                              rng.choice(DIGITS), RandomInward(rng))
+
+def RandomDoubleDigitDistrict(rng):                    # e.g. SO1 4QQ
+    return "{}{} {}".format(rng.choice(DOUBLE_DIGIT_AREAS), rng.choice(DIGITS), RandomInward(rng))
+
+# Every failure class which Analyse() can report (i.e. all but OK and UNKNOWN)
+
+INVALID_GENERATORS = {
+    PCValidationCodes.JUNK:                   RandomJunk,
+    PCValidationCodes.INCORRECT_GROUPING:     RandomIncorrectGrouping,
+    PCValidationCodes.INWARD_MALFORMED:       RandomInwardMalformed,
+    PCValidationCodes.OUTWARD_MALFORMED:      RandomOutwardMalformed,
+    PCValidationCodes.OUTWARD_AA9A_MALFORMED: RandomOutwardAA9AMalformed,
+    PCValidationCodes.OUTWARD_AA9_MALFORMED:  RandomOutwardAA9Malformed,
+    PCValidationCodes.OUTWARD_A9_MALFORMED:   RandomOutwardA9Malformed,
+    PCValidationCodes.SINGLE_DIGIT_DISTRICT:  RandomSingleDigitDistrict,
+    PCValidationCodes.DOUBLE_DIGIT_DISTRICT:  RandomDoubleDigitDistrict,
+    }
+
+FAILURE_CLASSES = sorted(INVALID_GENERATORS, key=lambda status: status.value)
+
+
+def RandomInvalidPostCode(rng, status=None):
+    """
+    Returns a random postcode which fails to validate
+
+    Parameters:
+        rng:     random.Random instance
+        status:  The PCValidationCodes failure class the postcode should fall
+                 in to. If None, each class in FAILURE_CLASSES is equally likely
+    """
+    if status is None:
+        status = rng.choice(FAILURE_CLASSES)
+    return INVALID_GENERATORS[status](rng)
+
+
+def GenerateTestFile(filename, rows=2000000, invalid_ratio=0.1, seed=0, distinct=None,
+                     shuffle=False):
+    """
+    Writes a synthetic file in the same format as import_data.csv
+
+    Parameters:
+        filename:      Name of the file to write
+        rows:          Number of data rows (excluding the header)
+        invalid_ratio: Approximate proportion of rows with invalid postcodes,
+                       spread evenly over the failure classes (see 
+                       RandomInvalidPostCode)
+        seed:          Seed for the random number generator, so that files
+                       are reproducible
+        distinct:      If given, the valid postcodes are drawn from a pool of
+                       this many (as in real data, where many patients share
+                       a postcode) rather than each being generated afresh
+        shuffle:       If True the rows are written in a random order of row_id
+                       rather than in ascending order
+    """
+    rng = random.Random(seed)
+    if distinct:
+        pool = [RandomValidPostCode(rng) for i in range(distinct)]
+        valid = lambda: rng.choice(pool)
+    else:
+        valid = lambda: RandomValidPostCode(rng)
+    row_ids = range(1, rows + 1)
+    if shuffle:
+        row_ids = list(row_ids)
+        rng.shuffle(row_ids)
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['row_id', 'postcode'])
+        for row_id in row_ids:
+            if rng.random() < invalid_ratio:
+                postcode = RandomInvalidPostCode(rng)
+            else:
+                postcode = valid()
+            writer.writerow([row_id, postcode])
+    logging.info("Wrote {:,} rows to {}".format(rows, filename))
+
+
+def RunInChild(code):
+    """
+    Runs a fragment of Python code in a fresh interpreter and returns whatever
+    it printed as its last line of output.
+    """
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     universal_newlines=True)
+    return output.strip().splitlines()[-1]
+
+
+def BenchmarkImport(repeat=10):
+    """
+    Measures how long importing NHSPostCode takes in a fresh interpreter (as
+    it is imported by every worker process, for example).
+
+    Returns:
+        Best time in seconds
+    """
+    code = ("import time\n"
+            "start = time.perf_counter()\n"
+            "import NHSPostCode\n"
+            "print(time.perf_counter() - start)")
+    seconds = min(float(RunInChild(code)) for i in range(repeat))
+    logging.info("Import NHSPostCode: {:.1f}ms".format(seconds * 1000))
+    return seconds
+
+
+def BenchmarkRecordMemory(filename):
+    """
+    Measures the peak RSS of holding every row of filename in memory as
+    PostCode objects and as PostCodeRecord objects (see Part 3).
+
+    Returns:
+        Dictionary of peak RSS in bytes keyed on the class name
+    """
+    results = {}
+    for classname in ['PostCode', 'PostCodeRecord']:
+        code = ("import csv, NHSPostCode\n"
+                "with open({!r}) as infile:\n"
+                "    records = [NHSPostCode.{}(r[1], r[0]) for r in csv.reader(infile)][1:]\n"
+                "print(NHSPostCode.PeakMemoryUsage())").format(filename, classname)
+        results[classname] = int(RunInChild(code))
+        logging.info("{}: peak RSS {:,.0f}MB".format(classname, results[classname]/2**20))
+    return results
+
+
+def BenchmarkAnalysis(filename, repeat=3):
+    """
+    Compares the throughput of validating every postcode in filename with
+    and without analysis of the postcodes which fail.
+
+    Returns:
+        Dictionary of postcodes/second keyed on 'plain' and 'analysed'
+    """
+    from NHSPostCode import PostCode
+    with open(filename) as infile:
+        postcodes = [r[1] for r in csv.reader(infile)][1:]
+    results = {}
+    for name, analyse in [('plain', False), ('analysed', True)]:
+        seconds = min(timeit.repeat(lambda: [PostCode.Classify(p, analyse) for p in postcodes],
+                                    number=1, repeat=repeat))
+        results[name] = len(postcodes) / seconds
+        logging.info("Validation ({}): {:,.0f} postcodes/s".format(name, results[name]))
+    return results
+
+
+def BenchmarkValidateMany(filename, repeat=3):
+    """
+    Compares the throughput of validating every postcode in filename by
+    constructing a PostCode for each, with PostCode.Classify and with
+    NHSPostCode.ValidateMany.
+
+    Returns:
+        Dictionary of postcodes/second keyed on 'objects', 'classify' and 'many'
+    """
+    from NHSPostCode import PostCode, ValidateMany
+    with open(filename) as infile:
+        postcodes = [r[1] for r in csv.reader(infile)][1:]
+    results = {}
+    for name, validate in [('objects',  lambda: [PostCode(p).status for p in postcodes]),
+                           ('classify', lambda: [PostCode.Classify(p)[0] for p in postcodes]),
+                           ('many',     lambda: ValidateMany(postcodes))]:
+        seconds = min(timeit.repeat(validate, number=1, repeat=repeat))
+        results[name] = len(postcodes) / seconds
+        logging.info("Validation ({}): {:,.0f} postcodes/s".format(name, results[name]))
+    return results
+
+
+def BenchmarkSort(filename, repeat=3):
+    """
+    Compares sorting the PostCodeRecords from filename, shuffled, with their
+    __lt__ method and with NHSTechnicalTestPart3.SortPostCodeList (which sorts
+    on a key).
+
+    Returns:
+        Dictionary of seconds keyed on 'lt' and 'key'
+    """
+    from NHSPostCode import PostCodeRecord
+    from NHSTechnicalTestPart3 import SortPostCodeList
+    with open(filename) as infile:
+        records = [PostCodeRecord(r[1], r[0]) for r in csv.reader(infile)][1:]
+    random.Random(0).shuffle(records)
+    results = {}
+    for name, sort in [('lt', list.sort), ('key', SortPostCodeList)]:
+        results[name] = min(timeit.repeat(lambda: sort(records[:]), number=1, repeat=repeat))
+        logging.info("Sort ({}): {:.2f}s".format(name, results[name]))
+    return results
+
+
+def BenchmarkReaders(filename, repeat=3):
+    """
+    Compares the throughput of reading and validating every row of filename
+    with csv.DictReader (as Part 2 does), csv.reader (as Part 3 does) and
+    NHSPostCode.PostCodeReader, both yielding every row and (as Part 2 uses
+    it) only the rows which don't validate.
+
+    Returns:
+        Dictionary of rows/second keyed on 'dict', 'csv', 'mmap' and 'mmap_invalid'
+    """
+    from NHSPostCode import PostCode, PostCodeReader
+
+    def DictRows():
+        with open(filename) as infile:
+            return [PostCode.Classify(r['postcode'])[0] for r in csv.DictReader(infile)]
+
+    def CsvRows():
+        with open(filename) as infile:
+            return [PostCode.Classify(r[1])[0] for r in csv.reader(infile)][1:]
+
+    def MappedRows(valid=True):
+        with PostCodeReader.Open(filename, valid=valid) as reader:
+            list(reader)
+            return reader.rows
+
+    rows = len(CsvRows())
+    results = {}
+    for name, read in [('dict', DictRows), ('csv', CsvRows), ('mmap', MappedRows),
+                       ('mmap_invalid', lambda: MappedRows(False))]:
+        seconds = min(timeit.repeat(read, number=1, repeat=repeat))
+        results[name] = rows / seconds
+        logging.info("Reader ({}): {:,.0f} rows/s".format(name, results[name]))
+    return results
+
+
+def TimeStage(timings, stage, function, repeat=3):
+    """
+    Times function, recording the best of repeat calls in timings[stage]
+
+    Returns:
+        Whatever the last call of function returned
+    """
+    best = None
+    for i in range(repeat):
+        result  = None                                 # Free the last result first
+        start   = time.perf_counter()
+        result  = function()
+        seconds = time.perf_counter() - start
+        best    = seconds if best is None else min(best, seconds)
+    timings[stage] = best
+    logging.info("{}: {:.3f}s".format(stage, best))
+    return result
+
+
+def BenchmarkPart2(filename, repeat=3):
+    """
+    Times each stage of Part 2 on filename separately: reading the rows with
+    csv.DictReader, constructing a PostCode for each (which validates it), 
+    validating the postcodes alone (with PostCode.Classify), splitting off the 
+    rows which fail and writing them with a BlockWriter.
+
+    Returns:
+        Dictionary of seconds keyed on 'read', 'construct', 'validate', 
+        'split' and 'write'
+    """
+    from NHSPostCode import PostCode, BlockWriter
+
+    def Read():
+        with open(filename, newline='') as infile:
+            return list(csv.DictReader(infile))
+
+    def Write():
+        with tempfile.TemporaryFile('w', newline='') as errfile:
+            writer = BlockWriter(errfile, fieldnames=['row_id', 'postcode'])
+            writer.WriteHeader()
+            for record in failed:
+                writer.Write(record)
+            writer.Flush()
+
+    OK = PCValidationCodes.OK
+    timings = {}
+    records = TimeStage(timings, 'read', Read, repeat)
+    TimeStage(timings, 'construct',
+              lambda: [PostCode(r['postcode']).status for r in records], repeat)
+    statuses = TimeStage(timings, 'validate',
+                         lambda: [PostCode.Classify(r['postcode'])[0] for r in records], repeat)
+    failed = TimeStage(timings, 'split',
+                       lambda: list(compress(records, [s is not OK for s in statuses])), repeat)
+    TimeStage(timings, 'write', Write, repeat)
+    return timings
+
+
+def BenchmarkPart3(filename, repeat=3):
+    """
+    Times each stage of Part 3 on filename separately: reading the rows with
+    csv.reader, constructing a PostCodeRecord for each (which validates it),
+    validating the postcodes alone (with PostCode.Classify), analysing the 
+    postcodes which fail, splitting the records in to those which validate
+    and those which don't, sorting both (see SortPostCodeList) and writing 
+    both (see WriteOutputFile).
+
+    Returns:
+        Dictionary of seconds keyed on 'read', 'construct', 'validate',
+        'analysis', 'split', 'sort' and 'write'
+    """
+    from NHSPostCode import PostCode, PostCodeRecord
+    from NHSTechnicalTestPart3 import DenseRowIds, SortPostCodeList, WriteOutputFile
+
+    def Read():
+        with open(filename, newline='') as infile:
+            return list(csv.reader(infile))[1:]
+
+    def Split():
+        return ([p for p in records if p.status == OK],
+                [p for p in records if p.status != OK])
+
+    def Sort():
+        span = DenseRowIds(records)
+        lists = [list(successful), list(unsuccessful)]
+        for postcodes in lists:
+            SortPostCodeList(postcodes, span)
+        return lists
+
+    def Write():
+        with tempfile.TemporaryDirectory() as directory:
+            WriteOutputFile(os.path.join(directory, 'matched.csv'), ordered[0])
+            WriteOutputFile(os.path.join(directory, 'unmatched.csv'), ordered[1])
+
+    OK = PCValidationCodes.OK
+    timings = {}
+    rows = TimeStage(timings, 'read', Read, repeat)
+    records = TimeStage(timings, 'construct',
+                        lambda: [PostCodeRecord(r[1], r[0]) for r in rows], repeat)
+    TimeStage(timings, 'validate', lambda: [PostCode.Classify(r[1])[0] for r in rows], repeat)
+    del rows
+    TimeStage(timings, 'analysis',
+              lambda: [PostCode.Classify(p.postcode, True)[0] for p in records if p.status != OK],
+              repeat)
+    successful, unsuccessful = TimeStage(timings, 'split', Split, repeat)
+    ordered = TimeStage(timings, 'sort', Sort, repeat)
+    TimeStage(timings, 'write', Write, repeat)
+    return timings
+
+
+def Version():
+    """
+    Returns the git description (e.g. 28166a5-dirty) of the code being
+    benchmarked, or None if it isn't in a git repository
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def WriteResults(filename, results):
+    """
+    Writes the results of the benchmarks to filename (or stdout if it is '-')
+    as JSON, along with the version of the code and of Python they were 
+    measured with, so that they can be compared between versions.
+    """
+    results = dict(results, version=Version(), python=platform.python_version(),
+                   platform=platform.platform(),
+                   time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    if filename == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(filename, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+        logging.info("Wrote results to {}".format(filename))
+
+
+def ParseArguments():
+    """
+    Parse the command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the NHS Digital Technical Tests")
+    parser.add_argument("--input",
+                        help="Synthetic postcode data to generate and benchmark against",
+                        default="benchmark_data.csv")
+    parser.add_argument("--rows",
+                        help="Number of rows to generate",
+                        type=int, default=2000000)
+    parser.add_argument("--invalid",
+                        help="Proportion of invalid postcodes",
+                        type=float, default=0.1)
+    parser.add_argument("--distinct",
+                        help="Draw the valid postcodes from a pool of this many",
+                        type=int, default=None)
+    parser.add_argument("--no-generate",
+                        help="Use the existing input file rather than generating it",
+                        action="store_true")
+    parser.add_argument("--shuffle",
+                        help="Generate the rows in a random order of row_id",
+                        action="store_true")
+    parser.add_argument("--repeat",
+                        help="Number of times to repeat each measurement (the best is kept)",
+                        type=int, default=3)
+    parser.add_argument("--json",
+                        help="File to which to write the results as JSON ('-' for stdout)",
+                        default=None)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    """
+    Generates a synthetic input file and runs the benchmarks against it.
+
+    Command line arguments:
+        --input:       Name of the synthetic input file
+        --rows:        Number of rows to generate
+        --invalid:     Proportion of invalid postcodes
+        --distinct:    Number of distinct valid postcodes
+        --no-generate: Reuse an existing input file
+        --shuffle:     Generate the rows in a random order
+        --repeat:      Number of times to repeat each measurement
+        --json:        File to which to write the results as JSON
+    """
+    args = ParseArguments()
+    logging.basicConfig(stream = sys.stderr if args.json == '-' else sys.stdout,
+                level = logging.DEBUG,
+                format = '%(asctime)s:%(levelname)s:%(message)s')
+
+    results = {'input': args.input}
+    if not args.no_generate:
+        GenerateTestFile(args.input, args.rows, args.invalid, distinct=args.distinct,
+                         shuffle=args.shuffle)
+        results['generated'] = {'rows': args.rows, 'invalid': args.invalid,
+                                'distinct': args.distinct, 'shuffle': args.shuffle}
+    results['import']   = BenchmarkImport()
+    results['memory']   = BenchmarkRecordMemory(args.input)
+    results['analysis'] = BenchmarkAnalysis(args.input, args.repeat)
+    results['validate'] = BenchmarkValidateMany(args.input, args.repeat)
+    results['sort']     = BenchmarkSort(args.input, args.repeat)
+    results['readers']  = BenchmarkReaders(args.input, args.repeat)
+    results['part2']    = BenchmarkPart2(args.input, args.repeat)
+    results['part3']    = BenchmarkPart3(args.input, args.repeat)
+    if args.json:
+        WriteResults(args.json, results)
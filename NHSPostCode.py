@@ -89,7 +89,9 @@ The exercise is to implement the regular expression (re) above AS IS.
 
    It would be possible to extend the RE to cope with all these cases, 
    but that would add to its complexity, reduce its performance and 
-   still not guarantee to catch all invalid postcodes. 
+   still not guarantee to catch all invalid postcodes. Instead the valid 
+   postcodes can be checked against a reference list of those which exist
+   (see Gazetteer).
    
     
 @author: Tim Greening-Jackson
@@ -98,22 +100,64 @@ import re
 import enum
 import logging
 import sys
+import csv
+import collections
+import contextlib
+import functools
+import importlib
+import io
+import mmap
+import os
+import time
+from array import array
+from itertools import accumulate, compress, islice, product, starmap
+from operator import eq, ne, not_
 
-# Set up logging (principally used for interactive debugging
-# purposes)
+# The module doesn't configure logging itself (that is up to the application
+# importing it, e.g. the Part 2 and Part 3 scripts) but logs through its own
+# logger, so as not to configure the root logger on its first message either.
 
-logging.basicConfig(stream = sys.stdout, level = logging.DEBUG, 
-                format = '%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
 
 # Check the version number. enums were only introduced in Python 3.4
 
-if (sys.version_info.major < 3) or (sys.version_info.major == 3 and 
-                                   sys.version_info.minor < 4):
-    logging.error("Requires Python >= 3.4 to run. Aborting execution.")
-    sys.exit()
-else:
-    logging.info("Python {}.{} detected".format(sys.version_info.major,
-                                            sys.version_info.minor))
+if sys.version_info < (3, 4):
+    raise ImportError("Requires Python >= 3.4 to run")
+
+
+class LazyRE:
+    """
+    A class attribute holding a regular expression which isn't compiled until
+    it is first used, e.g.
+
+        class PostCode:
+            InwardRE = LazyRE(r'[0-9][ABD-HJLNP-UW-Z]{2}')
+
+    The first time PostCode.InwardRE is looked up the RE is compiled and
+    replaces the LazyRE on the class, so from then on it is an ordinary class
+    attribute which costs no more to look up than if it had been compiled 
+    when the class was defined. Compiling every RE in the module (some of 
+    them long and verbose) when it's imported would slow down the start of 
+    every process which imports it, such as worker processes, whether or
+    not they use them.
+    """
+
+    def __init__(self, pattern, flags=0):
+        """
+        Parameters:
+            pattern: The RE (str or bytes) as for re.compile
+            flags:   As for re.compile
+        """
+        self.pattern = pattern
+        self.flags   = flags
+
+    def __get__(self, instance, owner):
+        compiled = re.compile(self.pattern, self.flags)
+        for cls in owner.__mro__:                   # Find the class which defined it
+            for name, value in list(vars(cls).items()):
+                if value is self:
+                    setattr(cls, name, compiled)
+        return compiled
 
 
 class PCValidationCodes(enum.Enum):
@@ -137,14 +181,43 @@ class PCValidationCodes(enum.Enum):
     JUNK                   =  9 
     SINGLE_DIGIT_DISTRICT  = 10 
     DOUBLE_DIGIT_DISTRICT  = 11 
+    NOT_FOUND              = 12                 # Matches the RE but isn't in the Gazetteer
+
+
+class PCValidationEngines(enum.Enum):
+    """
+    Enumeration of the ways in which a postcode can be matched against
+    the specified RE.
+
+    REGEX:        The compiled RE itself (PostCode.RE)
+    TABLE:        The precomputed lookup tables in PostCodeTable, which give
+                  exactly the same results
+    SINGLE_MATCH: A single match against PostCode.FastRE, which does the
+                  grouping, splitting and validation all at once
+    """
+    REGEX        = 1
+    TABLE        = 2
+    SINGLE_MATCH = 3
+
+
+# Looking up an enum member (e.g. PCValidationCodes.OK) is surprisingly slow,
+# about 170ns on Python 3.11, which is nearly as long as matching a postcode
+# against the RE. So the code which runs once per postcode uses these instead.
+
+_OK                 = PCValidationCodes.OK
+_UNKNOWN            = PCValidationCodes.UNKNOWN
+_INCORRECT_GROUPING = PCValidationCodes.INCORRECT_GROUPING
+_TABLE              = PCValidationEngines.TABLE
+_SINGLE_MATCH       = PCValidationEngines.SINGLE_MATCH
 
 
 class PostCode:
     """
     Very simple class to contain a postcode and (if supplied) a row_id
     """
-    # Compile the RE for speed (note that the re.VERBOSE flag should
-    # automatically trim whitespace and comments)
+    # The RE is compiled for speed, the first time it's used (see LazyRE).
+    # (Note that the re.VERBOSE flag should automatically trim whitespace 
+    # and comments)
     
     
     REString = """
@@ -170,9 +243,56 @@ class PostCode:
         \s[0-9][ABD-HJLNP-UW-Z]{2}
         )
     """
-    RE = re.compile(REString, re.VERBOSE)
+    RE = LazyRE(REString, re.VERBOSE)
+
+    # The constructor splits the postcode in to whitespace separated groups,
+    # and then matches it against the RE: two passes. FastRE does both at once.
+    # It is the RE with the outward and inward parts as named groups, and it
+    # only matches if (as the split requires) there is no whitespace after 
+    # the inward part other than at the end. GIR 0AA's outward part is GIR.
+
+    FastREString = r"""
+    (?P<outward>
+        GIR(?=\s0AA) |
+        # A9 or A99 prefix
+        [A-PR-UWYZ][0-9][0-9]? |
+        # AA99 prefix with some excluded areas
+        [A-PR-UWYZ][A-HK-Y][0-9](?<!(?:BR|FY|HA|HD|HG|HR|HS|HX|JE|LD|SM|SR|WC|WN|ZE)[0-9])[0-9] |
+        # AA9 prefix with some excluded areas
+        [A-PR-UWYZ][A-HK-Y](?<!AB|LL|SO)[0-9] |
+        # WC1A prefix
+        WC[0-9][A-Z] |
+        # A9A prefix
+        [A-PR-UWYZ][0-9][A-HJKPSTUW] |
+        # AA9A prefix
+        [A-PR-UWYZ][A-HK-Y][0-9][ABEHMNPRVWXY]
+    )
+    \s
+    # 9AA suffix, plus anything else up to the next whitespace
+    (?P<inward>[0-9][ABD-HJLNP-UW-Z]{2}\S*)
+    \s*\Z
+    """
+    FastRE  = LazyRE(FastREString, re.VERBOSE)
+    SplitRE = LazyRE(r"\s")
 
-    def __init__(self, rawtext, row_id=None, analyse=False):
+    # The rules used by Analyse() and the Validate...() methods below, compiled
+    # once here rather than looked up (or, for the lists of areas, rebuilt) on
+    # every call
+
+    CharactersRE   = LazyRE(r'^\w+\s\w+$')
+    InwardRE       = LazyRE(r'[0-9][ABD-HJLNP-UW-Z]{2}')
+    AA9AShapeRE    = LazyRE(r'^[A-Z]{2}\d[A-Z]$')
+    AA9ShapeRE     = LazyRE(r'^[A-Z]{2}\d{1,2}$')
+    A9ShapeRE      = LazyRE(r'^[A-Z]\d{1,2}$')
+    OutwardAA9ARE  = LazyRE(r'^([A-PR-UWYZ])([A-HK-Y])([0-9])([ABEHMNPRVWXY])$')
+    OutwardAA9RE   = LazyRE(r'^([A-PR-UWYZ][A-HK-Y])([0-9]+)$')
+    OutwardA9RE    = LazyRE(r'^([A-PR-UWYZ])([0-9]+)$')
+
+    SingleDigitAreas = frozenset("BR|FY|HA|HD|HG|HR|HS|HX|JE|LD|SM|SR|WC|WN|ZE".split("|"))
+    DoubleDigitAreas = frozenset("AB|LL|SO".split("|"))
+
+    def __init__(self, rawtext, row_id=None, analyse=False,
+                 engine=PCValidationEngines.REGEX, cache=None):
         """
         Parameters:
             raw:     The raw text of the postcode which will be validated
@@ -183,6 +303,15 @@ class PostCode:
                      that a particular PostCode didn't validate for reasons of performance.
                      However, in unit testing we would. So this flag controls validation
                      of those postcodes which don't validate
+
+            engine:  A PCValidationEngines value saying how to match the postcode
+                     against the RE. With PCValidationEngines.TABLE there is no 
+                     re.Match object, so match is always None. With
+                     PCValidationEngines.SINGLE_MATCH match is against FastRE.
+                     The status is the same whichever engine is used.
+
+            cache:   An optional ValidationCache. If supplied the status and the
+                     outward and inward parts come from the cache (and match is None).
                      
         Note:
             
@@ -201,39 +330,113 @@ class PostCode:
         except (TypeError, ValueError):             # be much easier and faster for
             self.row_id = None                      # searching/sorting etc.  
             
+        if cache is not None:                       # Previously validated?
+            self.match = None
+            self.status, self.outward, self.inward = cache.Classify(rawtext, analyse, engine)
+            return
+
+        # In single match mode a successful match against FastRE gives us
+        # everything we need. Only if it fails do we need to work out why.
+
+        if engine is _SINGLE_MATCH:
+            self.match = PostCode.FastRE.match(rawtext)
+            if self.match:
+                self.outward, self.inward = self.match.group('outward', 'inward')
+                self.status = _OK
+                return
 
         # Split the postcode in to its inward and outward groups, so for M1 7EP 
         # the outward is "M1" and the inward "7EP". If there aren't exactly
         # two groups then reject the postcode (no need to do the re.match())
         
-        groups = re.split("\s", self.postcode.strip())
+        groups = PostCode.SplitRE.split(self.postcode.strip())
 
         if len(groups) != 2:
             self.outward  = None                    # Shouldn't need to set these
             self.inward   = None                    # to None but probably wiser
             self.match    = None                    # in case someone refers to them elsewhere.
-            self.status   = PCValidationCodes.INCORRECT_GROUPING
+            self.status   = _INCORRECT_GROUPING
         else:
             self.outward  = groups[0]
             self.inward   = groups[1]           
-            self.match    = PostCode.RE.match(rawtext) 
-            if self.match:                          # Clean match against RE
-                self.status   = PCValidationCodes.OK   
+            if engine is _TABLE:
+                self.match = None
+                matched    = PostCodeTable.Match(rawtext)
+            elif engine is _SINGLE_MATCH:
+                matched    = None                   # FastRE has already failed
+            else:
+                self.match = PostCode.RE.match(rawtext) 
+                matched    = self.match
+            if matched:                             # Clean match against RE
+                self.status   = _OK   
             else:                                   # Match failed
                 if analyse:                         # Do we test to see why it failed?...
                     self.status = self.Analyse()
                 else:                               # ... or just put it down as UNKNOWN?
-                    self.status = PCValidationCodes.UNKNOWN
+                    self.status = _UNKNOWN
             
 
+    @staticmethod
+    def Classify(rawtext, analyse=False, engine=PCValidationEngines.REGEX):
+        """
+        Validates rawtext exactly as the constructor does, but without creating
+        a PostCode object (or holding on to the match object) afterwards.
+
+        Parameters:
+            rawtext: The raw text of the postcode which will be validated
+            analyse: As for the constructor
+            engine:  As for the constructor
+
+        Returns:
+            (status, outward, inward). outward and inward are None if the
+            postcode doesn't have exactly two groups.
+        """
+        if engine is _SINGLE_MATCH:
+            match = PostCode.FastRE.match(rawtext)
+            if match:
+                outward, inward = match.group('outward', 'inward')
+                return _OK, outward, inward
+        groups = PostCode.SplitRE.split(rawtext.strip())
+        if len(groups) != 2:
+            return _INCORRECT_GROUPING, None, None
+        if engine is _TABLE:
+            matched = PostCodeTable.Match(rawtext)
+        elif engine is _SINGLE_MATCH:
+            matched = None                  # FastRE has already failed
+        else:
+            matched = PostCode.RE.match(rawtext)
+        if matched:
+            return _OK, groups[0], groups[1]
+        if analyse:
+            # Analyse() only needs the text and its two parts, which we already
+            # have, so don't pay for splitting and matching all over again
+            postcode = PostCode.__new__(PostCode)
+            postcode.postcode, postcode.outward, postcode.inward = rawtext, groups[0], groups[1]
+            status = postcode.Analyse()
+        else:
+            status = _UNKNOWN
+        return status, groups[0], groups[1]
+
     def __repr__(self):
         return "{}: {}".format(self.postcode, self.row_id)
     
+    def SortKey(self):
+        """
+        Returns the key on which PostCodes are sorted: row_id order, with 
+        PostCodes which have no row_id after all those which do, and ties 
+        broken on the postcode. This is defined for every PostCode (a row_id
+        of 0 is a row_id like any other) and is what __lt__ compares.
+
+        Note that None is only ever compared with None, as the first element
+        of the key separates PostCodes with and without row_ids.
+        """
+        return (self.row_id is None, self.row_id, self.postcode)
+
     def __lt__(self, other):                       # Required to sort PostCodes in to row_id order
-        if self.row_id and other.row_id:           # If they both have row_ids
-            return self.row_id < other.row_id
-        else:                                      # But we might also want to sort postcodes with no row_id
-            return self.postcode < other.postcode
+        mine, theirs = self.row_id, other.row_id
+        if mine != theirs and mine is not None and theirs is not None:
+            return mine < theirs                   # The usual case, so avoid building the keys
+        return self.SortKey() < other.SortKey()
 
     def Analyse(self):
         """
@@ -256,18 +459,18 @@ class PostCode:
         """
 
         status = self.ValidateCharacters()       # See if it's junk/nonsense
-        if status != PCValidationCodes.OK:
+        if status is not _OK:
             return status
 
         status = self.ValidateInward()          # Test the inward part 
-        if status != PCValidationCodes.OK:
+        if status is not _OK:
             return status
 
         status = self.ValidateOutward()         # Test the outward part
-        if status != PCValidationCodes.OK:
+        if status is not _OK:
             return status
 
-        return PCValidationCodes.OK
+        return _OK
         
 
     def ValidateCharacters(self):
@@ -277,8 +480,8 @@ class PostCode:
         separated by a single whitespace.
         """
         
-        if re.match(r'^\w+\s\w+$', self.postcode):
-            return PCValidationCodes.OK
+        if PostCode.CharactersRE.match(self.postcode):
+            return _OK
         else:
             return PCValidationCodes.JUNK
 
@@ -289,11 +492,11 @@ class PostCode:
         Determine what kind of outward code it is 
         (as they all have potentially separate rules).
         """
-        if re.match("^[A-Z]{2}\d[A-Z]$", self.outward):   # Is it an AA9A
+        if PostCode.AA9AShapeRE.match(self.outward):       # Is it an AA9A
             return self.ValidateOutwardAA9A()
-        elif re.match("^[A-Z]{2}\d{1,2}$", self.outward): # Is it an AA9/AA99
+        elif PostCode.AA9ShapeRE.match(self.outward):      # Is it an AA9/AA99
             return self.ValidateOutwardAA9()
-        elif re.match("^[A-Z]\d{1,2}$", self.outward):    # Is it an A9/A99
+        elif PostCode.A9ShapeRE.match(self.outward):       # Is it an A9/A99
             return self.ValidateOutwardA9()
         else:
             return PCValidationCodes.OUTWARD_MALFORMED    # Don't know what it is
@@ -303,8 +506,8 @@ class PostCode:
         Tests that the inward part (e.g. "7EP") is correctly formed as per the
         supplied RE
         """
-        if re.match('[0-9][ABD-HJLNP-UW-Z]{2}', self.inward):
-            return PCValidationCodes.OK
+        if PostCode.InwardRE.match(self.inward):
+            return _OK
         else:
             return PCValidationCodes.INWARD_MALFORMED
         
@@ -324,10 +527,10 @@ class PostCode:
             the only allowable districts in the EC area are EC1x - EC4x etc.,
             the only allowable areas as EC, SW, NW etc.
         """
-        match = re.match('^([A-PR-UWYZ])([A-HK-Y])([0-9])([ABEHMNPRVWXY])$', self.outward)
+        match = PostCode.OutwardAA9ARE.match(self.outward)
 
         if match:
-            return PCValidationCodes.OK
+            return _OK
         else:
             return PCValidationCodes.OUTWARD_AA9A_MALFORMED
             
@@ -348,9 +551,7 @@ class PostCode:
             is beyond the scope of this exercise) test for areas which
             are allowed a zero districts etc.
         """
-        SingleDigitDistricts = "BR|FY|HA|HD|HG|HR|HS|HX|JE|LD|SM|SR|WC|WN|ZE".split("|")
-        DoubleDigitDistricts = "AB|LL|SO".split("|")
-        match = re.match('^([A-PR-UWYZ][A-HK-Y])([0-9]+)$', self.outward)
+        match = PostCode.OutwardAA9RE.match(self.outward)
 
         # Some areas e.g. AB can only have double digit districts e.g. AB23
         # whereas others e.g. FY can only have single digits. So if the pattern
@@ -358,12 +559,13 @@ class PostCode:
         #
         # If it doesn't match then by definition it's malformed.
         if match:
-            if match.groups()[0] in SingleDigitDistricts and len(match.groups()[1]) > 1:
+            area, district = match.groups()
+            if area in PostCode.SingleDigitAreas and len(district) > 1:
                 return PCValidationCodes.SINGLE_DIGIT_DISTRICT
-            elif match.groups()[0] in DoubleDigitDistricts and len(match.groups()[1]) < 2:
+            elif area in PostCode.DoubleDigitAreas and len(district) < 2:
                 return PCValidationCodes.DOUBLE_DIGIT_DISTRICT
             else:
-                return PCValidationCodes.OK
+                return _OK
         else:
             return PCValidationCodes.OUTWARD_AA9_MALFORMED
 
@@ -384,14 +586,1935 @@ class PostCode:
             This is a very simple check against a simple RE as specified.
 
         """
-        match = re.match('^([A-PR-UWYZ])([0-9]+)$', self.outward)
+        match = PostCode.OutwardA9RE.match(self.outward)
         if match:
-            return PCValidationCodes.OK
+            return _OK
         else:
             return PCValidationCodes.OUTWARD_A9_MALFORMED
 
 
+class PostCodeTable:
+    """
+    Table-driven alternative to matching against PostCode.RE.
+
+    Every outward code the RE can accept has one of only a handful of shapes
+    (A9, A99, AA9, AA99, WC9A, A9A and AA9A) built from a few character
+    classes, so rather than running the RE we precompute the set of every
+    legal outward code (about 120,000 of them) and every legal inward code
+    (4,000) from those character classes, and validation becomes two O(1)
+    set lookups.
+
+    Match() gives exactly the same accept/reject results as PostCode.RE.match(),
+    warts and all: i.e. it matches the beginning of the string and ignores any
+    trailing junk, the separator can be any single whitespace character and
+    GIR 0AA is a special case. The tables are built the first time they are
+    needed.
+    """
+    AREA_FIRST     = "ABCDEFGHIJKLMNOPRSTUWYZ"    # [A-PR-UWYZ]
+    AREA_SECOND    = "ABCDEFGHKLMNOPQRSTUVWXY"    # [A-HK-Y]
+    A9A_LETTERS    = "ABCDEFGHJKPSTUW"            # [A-HJKPSTUW]
+    AA9A_LETTERS   = "ABEHMNPRVWXY"               # [ABEHMNPRVWXY]
+    INWARD_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"       # [ABD-HJLNP-UW-Z]
+    LETTERS        = "ABCDEFGHIJKLMNOPQRSTUVWXYZ" # [A-Z]
+    DIGITS         = "0123456789"                 # [0-9]
+
+    SINGLE_DIGIT_AREAS = PostCode.SingleDigitAreas
+    DOUBLE_DIGIT_AREAS = PostCode.DoubleDigitAreas
+
+    OUTWARDS = None     # Built by BuildTables()
+    INWARDS  = None
+
+    @classmethod
+    def BuildTables(cls):
+        """
+        Enumerates every outward and inward code allowed by the RE
+        """
+        def join(*classes):
+            return ("".join(chars) for chars in product(*classes))
+
+        areas = ["".join(area) for area in product(cls.AREA_FIRST, cls.AREA_SECOND)]
+        outwards = set()
+        outwards.update(join(cls.AREA_FIRST, cls.DIGITS))                         # A9
+        outwards.update(join(cls.AREA_FIRST, cls.DIGITS, cls.DIGITS))             # A99
+        outwards.update(join([a for a in areas if a not in cls.SINGLE_DIGIT_AREAS],
+                             cls.DIGITS, cls.DIGITS))                             # AA99
+        outwards.update(join([a for a in areas if a not in cls.DOUBLE_DIGIT_AREAS],
+                             cls.DIGITS))                                         # AA9
+        outwards.update(join(["WC"], cls.DIGITS, cls.LETTERS))                    # WC9A
+        outwards.update(join(cls.AREA_FIRST, cls.DIGITS, cls.A9A_LETTERS))        # A9A
+        outwards.update(join(areas, cls.DIGITS, cls.AA9A_LETTERS))                # AA9A
+        cls.OUTWARDS = frozenset(outwards)
+        cls.INWARDS  = frozenset(join(cls.DIGITS, cls.INWARD_LETTERS, cls.INWARD_LETTERS))
+
+        # The tables are bound as default arguments so that every lookup is local
+        def Match(text, outwards=cls.OUTWARDS, inwards=cls.INWARDS, slow=cls.SlowMatch):
+            # The outward code never contains whitespace, so in the usual
+            # case the separator is the first space
+            outward, _, rest = text.partition(' ')
+            if outward in outwards and rest[:3] in inwards:
+                return True
+            # Every whitespace character other than a space is unprintable
+            if outward != 'GIR' and text.isprintable():
+                return False
+            return slow(text)
+        cls.Match = staticmethod(Match)
+
+    @classmethod
+    def Match(cls, text):
+        """
+        Returns True if text matches the specified RE, otherwise False.
+
+        The first call builds the tables, which replaces this method with
+        the much faster version defined in BuildTables().
+        """
+        if cls.OUTWARDS is None:
+            cls.BuildTables()
+        return cls.Match(text)
+
+    @classmethod
+    def SlowMatch(cls, text):
+        """
+        Handles the rare cases which the fast Match() can't: a separator other
+        than a space and GIR 0AA
+        """
+        for split in (2, 3, 4):
+            if text[split:split+1].isspace():
+                if text[:split] in cls.OUTWARDS and text[split+1:split+4] in cls.INWARDS:
+                    return True
+                break
+        return text[:3] == 'GIR' and text[3:4].isspace() and text[4:7] == '0AA'
+
+
+class PostCodeRecord:
+    """
+    Compact record of a validated postcode for bulk operations.
+
+    A PostCode object carries a per-instance __dict__ along with the outward
+    and inward strings and a live re.Match object, which adds up to several
+    hundred bytes per row. When we hold ~2M postcodes in memory at once (see
+    Part 3) that overhead dominates. A PostCodeRecord uses __slots__, never
+    keeps the match object and only keeps the outward and inward parts if
+    asked to (they are None otherwise).
+
+    A full PostCode (e.g. to analyse a failed record) can be rebuilt from
+    a record with ToPostCode().
+    """
+    __slots__ = ('postcode', 'row_id', 'status', 'outward', 'inward')
+
+    def __init__(self, rawtext, row_id=None, analyse=False, keep_parts=False,
+                 engine=PCValidationEngines.REGEX, cache=None):
+        """
+        Parameters:
+            rawtext:    The raw text of the postcode which will be validated
+            row_id:     The row_id read from the file. Converted to integer if possible
+            analyse:    As for PostCode
+            keep_parts: If True keep the outward and inward parts of the postcode
+            engine:     As for PostCode
+            cache:      As for PostCode
+        """
+        self.postcode = rawtext
+        try:
+            self.row_id = int(row_id)
+        except (TypeError, ValueError):
+            self.row_id = None
+        classify = PostCode.Classify if cache is None else cache.Classify
+        self.status, outward, inward = classify(rawtext, analyse, engine)
+        if keep_parts:
+            self.outward = outward
+            self.inward  = inward
+        else:
+            self.outward = None
+            self.inward  = None
+
+    @classmethod
+    def FromPostCode(cls, postcode, keep_parts=False):
+        """
+        Creates a record from an existing PostCode object without revalidating it
+        """
+        record = cls.__new__(cls)
+        record.postcode = postcode.postcode
+        record.row_id   = postcode.row_id
+        record.status   = postcode.status
+        record.outward  = postcode.outward if keep_parts else None
+        record.inward   = postcode.inward  if keep_parts else None
+        return record
+
+    def ToPostCode(self, analyse=False):
+        """
+        Rebuilds (and revalidates) a full PostCode object from the record
+        """
+        return PostCode(self.postcode, self.row_id, analyse)
+
+    __repr__ = PostCode.__repr__
+    SortKey  = PostCode.SortKey
+    __lt__   = PostCode.__lt__
+
+
+def ValidateMany(postcodes, analyse=False, engine=PCValidationEngines.REGEX, cache=None,
+                 block_size=65536):
+    """
+    Validates many postcodes at once, giving exactly the same statuses as
+    PostCode would, but without creating any object per postcode.
+
+    Parameters:
+        postcodes:  Iterable of the raw text of the postcodes
+        analyse:    As for PostCode
+        engine:     As for PostCode
+        cache:      Optional ValidationCache
+        block_size: Number of postcodes to validate at a time
+
+    Returns:
+        array('b') of the PCValidationCodes values, in the same order as postcodes
+
+    Notes:
+        Whichever engine is used, a postcode is valid exactly when it matches
+        PostCode.FastRE. So all of the postcodes are first matched against it 
+        with map(), which runs in C, and turned in to 1 (PCValidationCodes.OK) 
+        or 0 in the same pass. Only the postcodes which don't match (usually
+        fewer than 10%) are then validated (and analysed) one at a time with
+        PostCode.Classify, through the cache if there is one, to find out 
+        what their status is.
+
+        The postcodes are taken a block at a time, so that a long iterable
+        (e.g. PostCodeBatch.Texts) is never all in memory at once.
+    """
+    classify  = PostCode.Classify if cache is None else cache.Classify
+    match     = PostCode.FastRE.match
+    statuses  = array('b')
+    postcodes = iter(postcodes)
+    block     = list(islice(postcodes, block_size))
+    while block:
+        matched = array('b', map(bool, map(match, block)))
+        for i in compress(range(len(block)), map(not_, matched)):
+            matched[i] = classify(block[i], analyse, engine)[0].value
+        statuses.extend(matched)
+        block = list(islice(postcodes, block_size))
+    return statuses
+
+
+class PostCodeBatch:
+    """
+    Columnar container for bulk validation of postcodes.
+
+    Rather than one Python object per row, the batch keeps:
+
+        row_ids:  array('q') of integer row_ids (NO_ROW_ID if there wasn't one)
+        statuses: array('b') of PCValidationCodes values (NOT_VALIDATED until
+                  Validate() has been called)
+        buffer:   bytearray holding all of the postcodes UTF-8 encoded and packed
+                  end to end
+        offsets:  array('q') such that postcode i is buffer[offsets[i]:offsets[i+1]]
+
+    so a 2M-row import costs a handful of large allocations instead of millions
+    of small ones, none of which the garbage collector has to traverse.
+    """
+    NO_ROW_ID     = 2**63 - 1   # Sorts rows without a row_id after all the others
+    NOT_VALIDATED = 0           # Not a PCValidationCodes value
+
+    def __init__(self, rows=()):
+        """
+        Parameters:
+            rows: Optional iterable of (row_id, postcode) pairs, e.g. a csv.reader
+                  positioned after the header row
+        """
+        self.row_ids  = array('q')
+        self.statuses = array('b')
+        self.buffer   = bytearray()
+        self.offsets  = array('q', [0])
+        self.Extend(rows)
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __iter__(self):
+        """
+        Yields (row_id, postcode, status) for each row. row_id is None if the
+        row didn't have one and status is None if it hasn't been validated.
+        """
+        for i, text in enumerate(self.Texts()):
+            yield self.RowId(i), text, self.Status(i)
+
+    @staticmethod
+    def ToRowId(row_id):
+        """
+        Returns row_id (str or bytes) as an integer, or NO_ROW_ID if it isn't one
+        which fits in the row_ids array (so a row_id of 2**63 or more is written
+        out empty, as a non-integer one is)
+        """
+        try:
+            row_id = int(row_id)
+        except (TypeError, ValueError):
+            return PostCodeBatch.NO_ROW_ID
+        return row_id if -PostCodeBatch.NO_ROW_ID <= row_id < PostCodeBatch.NO_ROW_ID \
+               else PostCodeBatch.NO_ROW_ID
+
+    def Append(self, rawtext, row_id=None):
+        """
+        Appends a single (unvalidated) postcode to the batch
+        """
+        self.row_ids.append(PostCodeBatch.ToRowId(row_id))
+        self.statuses.append(PostCodeBatch.NOT_VALIDATED)
+        self.buffer += rawtext.encode('utf-8')
+        self.offsets.append(len(self.buffer))
+
+    def Extend(self, rows):
+        """
+        Appends (row_id, postcode) pairs to the batch
+        """
+        for row in rows:
+            self.Append(row[1], row[0])
+
+    @classmethod
+    def Concatenate(cls, batches):
+        """
+        Returns a new batch of the rows of each of batches in turn, e.g. to put
+        back together a file which has been validated in chunks (see FileChunks)
+        """
+        batch = cls()
+        for other in batches:
+            base = len(batch.buffer)
+            batch.row_ids.extend(other.row_ids)
+            batch.statuses.extend(other.statuses)
+            batch.buffer += other.buffer
+            batch.offsets.extend(array('q', [offset + base for offset in other.offsets[1:]]))
+        return batch
+
+    def RowId(self, i):
+        row_id = self.row_ids[i]
+        return None if row_id == PostCodeBatch.NO_ROW_ID else row_id
+
+    def PostCode(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+
+    def Status(self, i):
+        status = self.statuses[i]
+        return None if status == PostCodeBatch.NOT_VALIDATED else PCValidationCodes(status)
+
+    def Texts(self):
+        """
+        Yields each of the postcodes in the batch as a str
+        """
+        offsets = self.offsets
+        text    = self.buffer.decode('utf-8')
+        if len(text) != len(self.buffer):           # Non-ASCII, so the byte offsets
+            buffer = self.buffer                    # don't apply to text
+            for i in range(len(self)):
+                yield buffer[offsets[i]:offsets[i+1]].decode('utf-8')
+        else:
+            for i in range(len(self)):
+                yield text[offsets[i]:offsets[i+1]]
+
+    def Validate(self, analyse=False, engine=PCValidationEngines.REGEX, cache=None):
+        """
+        Validates every postcode in the batch, exactly as PostCode would
+        (optionally through a ValidationCache, see ValidateMany), and records 
+        the results in statuses.
+        """
+        self.statuses = ValidateMany(self.Texts(), analyse, engine, cache)
+
+    def Select(self, indices):
+        """
+        Returns a new batch containing the rows at indices, in that order
+        """
+        batch   = type(self)()
+        buffer  = self.buffer
+        offsets = self.offsets
+        packed  = batch.buffer
+        ends    = batch.offsets
+        for i in indices:
+            packed += buffer[offsets[i]:offsets[i+1]]
+            ends.append(len(packed))
+        batch.row_ids  = array('q', (self.row_ids[i]  for i in indices))
+        batch.statuses = array('b', (self.statuses[i] for i in indices))
+        return batch
+
+    def Indices(self, status=PCValidationCodes.OK, invert=False):
+        """
+        Returns an array of the indices of the rows whose status is (or, if
+        invert is True, is not) status
+        """
+        value = status.value
+        if invert:
+            selected = (s != value for s in self.statuses)
+        else:
+            selected = (s == value for s in self.statuses)
+        return array('q', compress(range(len(self)), selected))
+
+    def Filter(self, status=PCValidationCodes.OK, invert=False):
+        """
+        Returns a new batch of the rows whose status is (or, if invert is True,
+        is not) status
+        """
+        return self.Select(self.Indices(status, invert))
+
+    def SortKey(self, i):
+        """
+        Returns the key on which row i is sorted, in the same order as 
+        PostCode.SortKey: its row_id (NO_ROW_ID, after all the others, if
+        it hasn't one) and then its postcode
+        """
+        return self.row_ids[i], self.PostCode(i)
+
+    def Order(self, indices):
+        """
+        Returns a list of indices (e.g. from Indices()) in the order of their
+        rows' SortKey. They are sorted on the row_id alone unless some rows 
+        share a row_id, when they are sorted again on the whole key, so that
+        ties are broken on the postcode just as they are for PostCodes.
+        """
+        row_id = self.row_ids.__getitem__
+        order  = sorted(indices, key=row_id)
+        if any(map(eq, map(row_id, order), map(row_id, islice(order, 1, None)))):
+            order.sort(key=self.SortKey)
+        return order
+
+    def SortByRowId(self):
+        """
+        Returns a new batch sorted in to ascending row_id order (see Order). 
+        Rows without a row_id go at the end.
+        """
+        return self.Select(self.Order(range(len(self))))
+
+    def WriteCSV(self, outfile, header=('row_id', 'postcode')):
+        """
+        Writes the batch to an open file in the same format, and with the same
+        quoting, as the input file. Returns the BlockWriter used to write it.
+        """
+        writer = BlockWriter(outfile)
+        if header:
+            writer.WriteHeader(header)
+        missing = PostCodeBatch.NO_ROW_ID
+        row_ids = (None if row_id == missing else row_id for row_id in self.row_ids)
+        writer.WritePairs(zip(row_ids, self.Texts()))
+        return writer
+
+
+class LineBatch(PostCodeBatch):
+    """
+    A PostCodeBatch whose "postcodes" are the rows' whole original lines, as
+    bytes in the input file's encoding, newline and all (see 
+    PostCodeReader.ReadLines). It can be split and sorted like any other 
+    batch, and is then written out exactly as it was read, without 
+    formatting the rows again.
+    """
+
+    LineRE  = LazyRE(rb'[^\n]+\n?')                 # Lines of a run, which are never empty
+    RowIdRE = LazyRE(rb'^[^,\n]*', re.MULTILINE)
+
+    def __init__(self, header=b'', encoding='utf-8', newline=b'\r\n'):
+        """
+        Parameters:
+            header:   The file's header line
+            encoding: The file's encoding
+            newline:  Newline to add to a line which hasn't got one (i.e. the
+                      last line of a file which doesn't end with a newline)
+        """
+        PostCodeBatch.__init__(self)
+        self.header   = header
+        self.encoding = encoding
+        self.newline  = newline
+
+    def AppendLine(self, line, row_id=None, status=None):
+        """
+        Appends a single line (bytes) with its row_id and (optional) status
+        """
+        self.row_ids.append(PostCodeBatch.ToRowId(row_id))
+        self.statuses.append(status.value if status else PostCodeBatch.NOT_VALIDATED)
+        self.buffer += line
+        if not line.endswith((b'\n', b'\r')):
+            self.buffer += self.newline
+        self.offsets.append(len(self.buffer))
+
+    def AppendRun(self, lines, status=PCValidationCodes.OK):
+        """
+        Appends a block of lines (bytes) which all have the same status and
+        whose row_ids are the text up to the first comma, as in a run of
+        lines matched by PostCodeReader.RunRE. Returns the number of lines.
+
+        Notes:
+            Every line is handled in C (by re.findall, map and 
+            itertools.accumulate) rather than by a loop in Python.
+        """
+        if not lines.endswith((b'\n', b'\r')):
+            lines += self.newline
+        lengths = list(map(len, LineBatch.LineRE.findall(lines)))
+        count   = len(lengths)
+        row_ids = LineBatch.RowIdRE.findall(lines)[:count]
+        try:
+            row_ids = array('q', map(int, row_ids))
+        except (ValueError, OverflowError):         # e.g. an empty row_id
+            row_ids = array('q', map(PostCodeBatch.ToRowId, row_ids))
+        self.row_ids.extend(row_ids)
+        self.statuses.frombytes(bytes((status.value,)) * count)
+        self.offsets.extend(map(len(self.buffer).__add__, accumulate(lengths)))
+        self.buffer += lines
+        return count
+
+    def SortKey(self, i):
+        """
+        As PostCodeBatch.SortKey, with the postcode read from row i's line
+        """
+        line = self.buffer[self.offsets[i]:self.offsets[i+1]].decode(self.encoding)
+        row  = next(csv.reader([line]), [])
+        return self.row_ids[i], row[1] if len(row) > 1 else ''
+
+    def Select(self, indices):
+        batch = PostCodeBatch.Select(self, indices)
+        batch.header, batch.encoding, batch.newline = self.header, self.encoding, self.newline
+        return batch
+
+    def WriteCSV(self, outfile, header=True):
+        """
+        Writes the original header line (if header is True) and lines to an 
+        open file. Returns the BlockWriter used to write them.
+        """
+        writer = BlockWriter(outfile)
+        if header:
+            writer.WriteBlock(self.header.decode(self.encoding))
+        writer.WriteBlock(self.buffer.decode(self.encoding), len(self))
+        return writer
+
+
+class FingerprintIndex:
+    """
+    Compact record of the rows of a run's input: the row_id, a fingerprint
+    (CRC32) of the postcode and the status of each row, in input order. 
+    Given the index of the previous run's input, Validate() only validates
+    the rows which are new or whose postcode has changed since, and reuses 
+    the previous status of the rest, as a status only depends on the postcode.
+
+    The index is saved (see Save) at the end of a run for the next run to
+    load. It costs 13 bytes a row on disk and in memory.
+
+    Notes:
+        As a night's input is almost always the previous night's with a few
+        rows changed, added or removed, the rows are compared a block at a 
+        time with the block at the same position in the previous index (with
+        array comparisons and map(), which run in C). Only where they don't
+        line up, as a row has been added or removed, is a row_id looked up
+        (see Find) to line them up again. If the rows of a block are in a
+        different order altogether the rest of the block is just validated.
+
+        Computing the fingerprints costs about half as much as validating
+        the rows with ValidateMany, so the saving is in validating (and
+        classifying) only the rows which have changed, not in reading them.
+
+        A changed postcode has a 1 in 2**32 chance of having the same CRC32
+        as the old one, so of keeping its old status. With 20k rows changing
+        a night, that is about once in 600 years.
+    """
+    MAGIC = b'NHSPCFP\x01'
+
+    def __init__(self, previous=None):
+        """
+        Parameters:
+            previous: Optional FingerprintIndex of the previous run's input
+        """
+        self.row_ids    = array('q')
+        self.hashes     = array('I')
+        self.statuses   = array('b')
+        self.previous   = previous
+        self.shift      = 0                         # Position in previous less position in this
+        self.where      = None                      # Lookup of previous's row_ids, see Find
+        self.reused     = 0
+        self.recomputed = 0
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    @classmethod
+    def Version(cls):
+        """
+        Returns a fingerprint of the REs, so that an index of statuses given by
+        different REs is never used
+        """
+        from zlib import crc32
+        return crc32((PostCode.REString + PostCode.FastREString).encode('utf-8'))
+
+    @classmethod
+    def Load(cls, filename):
+        """
+        Returns the index saved in filename, or None (after logging why) if 
+        there isn't one or it was made with different REs
+        """
+        index = cls()
+        try:
+            with open(filename, 'rb') as infile:
+                header = array('q')
+                if infile.read(len(cls.MAGIC)) != cls.MAGIC:
+                    raise ValueError("Not an index")
+                header.fromfile(infile, 2)
+                rows, version = header
+                if version != cls.Version():
+                    logger.warning("Index {} was made with different REs, so not using it"
+                                   .format(filename))
+                    return None
+                index.row_ids.fromfile(infile, rows)
+                index.hashes.fromfile(infile, rows)
+                index.statuses.fromfile(infile, rows)
+        except FileNotFoundError:
+            logger.warning("No index {}, so validating every row".format(filename))
+            return None
+        except (ValueError, EOFError):
+            logger.warning("Index {} is corrupt, so not using it".format(filename))
+            return None
+        logger.info("Loaded index of {:,} rows from {}".format(rows, filename))
+        return index
+
+    def Save(self, filename):
+        """
+        Writes the index to filename (replacing it only once it is complete)
+        """
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as outfile:
+            outfile.write(self.MAGIC)
+            array('q', [len(self), self.Version()]).tofile(outfile)
+            self.row_ids.tofile(outfile)
+            self.hashes.tofile(outfile)
+            self.statuses.tofile(outfile)
+        os.replace(temporary, filename)
+        logger.info("Wrote index of {:,} rows to {}".format(len(self), filename))
+
+    def Find(self, row_id):
+        """
+        Returns the position of row_id in the previous index, or None if it
+        isn't there
+
+        Notes:
+            The lookup is built when first needed: nothing at all if the 
+            previous row_ids were lo to hi in order, as they almost always 
+            are, else an array of the position of each row_id if they are 
+            dense (e.g. 1 to N in any order), which is much smaller than a 
+            dict, else a dict.
+        """
+        if self.where is None:
+            row_ids = self.previous.row_ids
+            present = row_ids
+            if PostCodeBatch.NO_ROW_ID in row_ids:
+                present = [row_id for row_id in row_ids if row_id != PostCodeBatch.NO_ROW_ID]
+            lo, hi  = (min(present), max(present)) if present else (0, -1)
+            if row_ids == array('q', range(lo, hi + 1)):
+                self.where = (lo, hi, range(len(row_ids)))
+            elif hi - lo < 2 * len(present):
+                where = array('q', [-1]) * (hi - lo + 1)
+                for position, row_id in enumerate(row_ids):
+                    if row_id != PostCodeBatch.NO_ROW_ID and where[row_id - lo] < 0:
+                        where[row_id - lo] = position
+                self.where = (lo, hi, where)
+            else:
+                self.where = {}
+                for position, row_id in enumerate(row_ids):
+                    self.where.setdefault(row_id, position)
+        if isinstance(self.where, dict):
+            return self.where.get(row_id)
+        lo, hi, where = self.where
+        if lo <= row_id <= hi and where[row_id - lo] >= 0:
+            return where[row_id - lo]
+        return None
+
+    @staticmethod
+    def Matching(new, i, old, j, limit, chunk=256):
+        """
+        Returns how many (up to limit) elements of array new from i on are 
+        the same as those of array old from j on, comparing them a chunk at 
+        a time (in C) first
+        """
+        for k in range(0, limit, chunk):
+            a = new[i + k:i + min(k + chunk, limit)]
+            b = old[j + k:j + min(k + chunk, limit)]
+            if a != b:
+                for n, (x, y) in enumerate(zip(a, b), k):
+                    if x != y:
+                        return n
+                return k + len(b)                   # old ran out
+        return limit
+
+    @staticmethod
+    def Differences(new, old, chunk=256):
+        """
+        Returns a list of the positions at which arrays new and old (of the 
+        same length) differ, comparing them a chunk at a time (in C) first
+        """
+        if new == old:
+            return []
+        return [i for k in range(0, len(new), chunk) if new[k:k + chunk] != old[k:k + chunk]
+                  for i in compress(range(k, k + chunk), map(ne, new[k:k + chunk], old[k:k + chunk]))]
+
+    def Validate(self, row_ids, postcodes, engine=PCValidationEngines.REGEX, cache=None):
+        """
+        Validates a block of rows, as ValidateMany would, but reusing the 
+        status the previous index has for any row with the same row_id and 
+        postcode, and adds the rows to this index.
+
+        Parameters:
+            row_ids:   List of the row_ids (as read, e.g. str) of the rows
+            postcodes: List of the raw text of their postcodes
+            engine:    As for PostCode
+            cache:     Optional ValidationCache
+
+        Returns:
+            array('b') of the PCValidationCodes values, in the same order as postcodes
+        """
+        from zlib import crc32
+        rows = len(postcodes)
+        try:
+            ids = array('q', map(int, row_ids))
+        except (ValueError, OverflowError):         # Some rows have no row_id (or a huge one)
+            ids = array('q', map(PostCodeBatch.ToRowId, row_ids))
+        hashes   = array('I', map(crc32, map(str.encode, postcodes)))
+        statuses = array('b', [PostCodeBatch.NOT_VALIDATED]) * rows
+        changed  = []
+        previous = self.previous
+        i        = 0
+        realign  = rows // 64 + 16                  # Give up if the rows are all over the place
+        while previous is not None and i < rows and realign:
+            # Reuse the statuses of the run of rows which line up with the 
+            # previous index, bar those whose postcodes have changed
+            start = len(self) + i + self.shift
+            run   = self.Matching(ids, i, previous.row_ids, start, rows - i) if start >= 0 else 0
+            if run:
+                statuses[i:i + run] = previous.statuses[start:start + run]
+                changed.extend(j + i for j in self.Differences(hashes[i:i + run], 
+                                                               previous.hashes[start:start + run]))
+                i += run
+                continue
+            # Rows added or removed: line up with the previous index again
+            realign -= 1
+            position = self.Find(ids[i]) if ids[i] != PostCodeBatch.NO_ROW_ID else None
+            if position is not None and position != start:
+                self.shift = position - len(self) - i
+            else:                                   # A new row
+                changed.append(i)
+                self.shift -= 1
+                i += 1
+        changed.extend(range(i, rows))
+        if changed:
+            validated = ValidateMany([postcodes[i] for i in changed], engine=engine, cache=cache)
+            for i, status in zip(changed, validated):
+                statuses[i] = status
+        self.row_ids.extend(ids)
+        self.hashes.extend(hashes)
+        self.statuses.extend(statuses)
+        self.recomputed += len(changed)
+        self.reused     += rows - len(changed)
+        return statuses
+
+    def LogStatistics(self):
+        """
+        Logs how many rows' statuses were reused from the previous index and
+        how many were validated
+        """
+        rows = self.reused + self.recomputed
+        logger.info("Reused the status of {:,} rows ({:.1%}) from the previous index and "
+                    "validated {:,}".format(self.reused, self.reused / rows if rows else 0,
+                                            self.recomputed))
+
+
+class Gazetteer:
+    """
+    Existence check against a reference list of the postcodes which actually
+    exist (e.g. the ~1.7M live postcodes of the ONS Postcode Directory). The
+    RE lets through postcodes which are well formed but don't exist, such as
+    M0 1AA or WC4 9PP (see the module notes), and Check() gives any of those 
+    which aren't in the list the status PCValidationCodes.NOT_FOUND.
+
+    The list is compiled once (see Compile) in to an index file, which is
+    memory mapped rather than read (see Open), so opening it costs next to 
+    nothing and none of the postcodes ever becomes a Python string.
+
+    Notes:
+        The index holds, for each outward code (district) in the list, in 
+        order, a bitmap of which of the 6,760 possible inward codes (a digit
+        and two letters) exist: 845 bytes a district, about 2.5MB for the 
+        ~3,000 districts of the real list, against over 100MB for 1.7M 
+        strings in a set. (A list spread much more thinly over districts,
+        e.g. of random postcodes, makes a bigger file, but only the pages
+        looked at are ever read.) Only the districts are read, in to a dict
+        of each to a memoryview of its bitmap, so looking a postcode up is a
+        dict lookup and a test of one bit: a perfect hash, with no searching.
+
+        Check() looks up about 1M valid postcodes a second (0.9-1.3M on 1M
+        of them, on one core), which is the cost of a Python call for each.
+        Taking the outward and inward codes from the groups of the FastRE 
+        match objects was slower (0.6-0.7M a second) and looking up a block
+        at a time with chained map()s, from slices of the postcodes, or 
+        slicing rather than splitting in Exists, no faster.
+    """
+    MAGIC   = b'NHSPCGZ\x01'
+    DIGITS  = '0123456789'
+    LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    BITMAP_BYTES = (len(DIGITS) * len(LETTERS) ** 2 + 7) // 8
+
+    def __init__(self, districts):
+        """
+        Use Open() rather than the constructor.
+
+        Parameters:
+            districts: Dict of each outward code to its bitmap (e.g. a 
+                       memoryview of the mapped index file)
+        """
+        self.districts = districts
+        self.empty     = bytes(self.BITMAP_BYTES)   # Of the districts which aren't in it
+        self.bits      = self.InwardBits()
+        self.checked   = 0                          # Postcodes looked up by Check
+        self.missing   = 0                          # ... which weren't found
+
+    @classmethod
+    def InwardBits(cls):
+        """
+        Returns a dict of each possible inward code to the (byte, mask) of its
+        bit in a district's bitmap
+        """
+        codes = map(''.join, product(cls.DIGITS, cls.LETTERS, cls.LETTERS))
+        return {code: (bit >> 3, 1 << (bit & 7)) for bit, code in enumerate(codes)}
+
+    @classmethod
+    def Compile(cls, postcodes, filename):
+        """
+        Compiles a reference list of postcodes in to a gazetteer index file.
+
+        Parameters:
+            postcodes: Iterable of the text of the postcodes which exist, in
+                       any order. Any which don't match PostCode.FastRE are
+                       skipped (and counted).
+            filename:  Name of the index file to write (replaced only once
+                       it is complete)
+
+        Returns:
+            Number of distinct postcodes compiled
+        """
+        bits    = cls.InwardBits()
+        bitmaps = collections.defaultdict(lambda: bytearray(cls.BITMAP_BYTES))
+        match   = PostCode.FastRE.match
+        skipped = 0
+        for postcode in postcodes:
+            matched = match(postcode)
+            if matched is None:
+                skipped += 1
+                continue
+            byte, mask = bits[matched.group('inward')[:3]]
+            bitmaps[matched.group('outward')][byte] |= mask
+        districts = sorted(bitmaps)
+        names     = ' '.join(districts).encode('ascii')
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as outfile:
+            outfile.write(cls.MAGIC)
+            array('q', [len(districts), len(names)]).tofile(outfile)
+            outfile.write(names)
+            for district in districts:
+                outfile.write(bitmaps[district])
+        os.replace(temporary, filename)
+        count = sum(bin(int.from_bytes(bitmap, 'big')).count('1') for bitmap in bitmaps.values())
+        logger.info("Compiled gazetteer of {:,} postcodes in {:,} districts to {}"
+                    .format(count, len(districts), filename))
+        if skipped:
+            logger.warning("Skipped {:,} reference postcodes which don't match the RE"
+                           .format(skipped))
+        return count
+
+    @classmethod
+    def Open(cls, filename):
+        """
+        Returns the Gazetteer compiled in to filename (see Compile), with its
+        bitmaps memory mapped. Raises FileNotFoundError if there is no such
+        file, or ValueError if it isn't a gazetteer index.
+        """
+        with open(filename, 'rb') as infile:
+            header = array('q')
+            try:
+                if infile.read(len(cls.MAGIC)) != cls.MAGIC:
+                    raise ValueError
+                header.fromfile(infile, 2)
+                count, size = header
+                names = infile.read(size).decode('ascii').split()
+            except (ValueError, EOFError):
+                raise ValueError("{} isn't a gazetteer index".format(filename))
+            start = infile.tell()
+            if (len(names) != count or 
+                os.fstat(infile.fileno()).st_size != start + count * cls.BITMAP_BYTES):
+                raise ValueError("Gazetteer index {} is corrupt".format(filename))
+            bitmaps = memoryview(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+        offsets   = range(start, start + count * cls.BITMAP_BYTES, cls.BITMAP_BYTES)
+        districts = {name: bitmaps[offset:offset + cls.BITMAP_BYTES] 
+                     for name, offset in zip(names, offsets)}
+        logger.info("Opened gazetteer of {:,} districts from {}".format(count, filename))
+        return cls(districts)
+
+    def Exists(self, postcode):
+        """
+        Returns True if postcode, which must match PostCode.FastRE (e.g. it 
+        validated OK), is in the gazetteer
+        """
+        outward, inward = postcode.split(None, 1)
+        byte, mask = self.bits[inward[:3]]
+        return bool(self.districts.get(outward, self.empty)[byte] & mask)
+
+    def Check(self, postcodes, statuses):
+        """
+        Changes the status of each postcode which validated OK but isn't in
+        the gazetteer to PCValidationCodes.NOT_FOUND.
+
+        Parameters:
+            postcodes: List of the raw text of the postcodes
+            statuses:  array('b') of their PCValidationCodes values (e.g. from 
+                       ValidateMany), which is changed in place
+
+        Returns:
+            statuses
+        """
+        valid   = list(compress(range(len(statuses)), map(_OK.value.__eq__, statuses)))
+        found   = map(self.Exists, map(postcodes.__getitem__, valid))
+        missing = list(compress(valid, map(not_, found)))
+        for i in missing:
+            statuses[i] = PCValidationCodes.NOT_FOUND.value
+        self.checked += len(valid)
+        self.missing += len(missing)
+        return statuses
+
+    def LogStatistics(self):
+        """
+        Logs how many postcodes were looked up and how many weren't found
+        """
+        logger.info("Looked up {:,} valid postcodes in the gazetteer, of which {:,} ({:.1%}) "
+                    "don't exist".format(self.checked, self.missing, 
+                                         self.missing / self.checked if self.checked else 0))
+
+
+class ValidationCache:
+    """
+    Bounded cache of validation results keyed on the raw postcode text.
+
+    Many patients share a postcode, so migration files repeat the same
+    postcodes many times over. Classify() has the same signature, and gives
+    the same results, as PostCode.Classify() but remembers them, so that a
+    repeated postcode isn't validated (or analysed) again. When the cache 
+    is full the least recently used entry is evicted.
+
+    The cache is functools.lru_cache, which is implemented in C and so 
+    costs much less per lookup than anything we could write in Python.
+    """
+
+    def __init__(self, maxsize=65536):
+        """
+        Parameters:
+            maxsize: Maximum number of entries to keep
+        """
+        self.maxsize  = maxsize
+        self.Classify = functools.lru_cache(maxsize=maxsize)(PostCode.Classify)
+
+    def Info(self):
+        """
+        Returns the cache statistics as a named tuple of hits, misses, maxsize
+        and currsize (see functools.lru_cache)
+        """
+        return self.Classify.cache_info()
+
+    def HitRate(self):
+        """
+        Returns the proportion of lookups which were hits (0 if there weren't any)
+        """
+        info = self.Info()
+        lookups = info.hits + info.misses
+        return info.hits / lookups if lookups else 0
+
+    def Clear(self):
+        """
+        Empties the cache and resets the statistics
+        """
+        self.Classify.cache_clear()
+
+    def LogStatistics(self):
+        """
+        Logs the hit rate and other statistics
+        """
+        info = self.Info()
+        logger.info("Validation cache: {:,} hits, {:,} misses ({:.1%} hit rate), {:,} of {:,} entries used"
+                     .format(info.hits, info.misses, self.HitRate(), info.currsize, self.maxsize))
+
+
+class RunStatistics:
+    """
+    The wall time, CPU time, number of rows and peak memory usage of each
+    stage (read, validate, split, sort, write) of a run, which can be logged
+    or written to a JSON metrics file (e.g. for a scheduler to alert on when
+    an import slows down).
+
+    Where two stages are done in the same pass over the rows (e.g. the rows
+    are validated as they are read) the time of both is recorded against the
+    later one. Time recorded against another stage while a stage is open 
+    (see Stage) isn't counted in that stage as well. CPU time is that of this
+    process only, not of any worker processes.
+
+    A RunStatistics is true if the run succeeded, so PerformTests can return
+    one where it used to return a Boolean.
+    """
+    STAGES = ('read', 'validate', 'split', 'sort', 'write')     # In the order they're reported
+
+    def __init__(self, **info):
+        """
+        Parameters:
+            info: Anything else to record about the run (e.g. the input file name)
+        """
+        self.info    = dict(info)
+        self.stages  = {}
+        self.success = False
+        self.wall    = 0.0                          # Totals recorded against all stages
+        self.cpu     = 0.0
+        self.start   = (time.perf_counter(), time.process_time())
+        self.end     = None
+
+    def __bool__(self):
+        return self.success
+
+    def Add(self, name, wall, cpu, rows=0):
+        """
+        Adds wall and CPU seconds and rows to stage name
+        """
+        stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'rows': 0, 
+                                              'peak_memory': None})
+        stage['wall'] += wall
+        stage['cpu']  += cpu
+        stage['rows'] += rows
+        stage['peak_memory'] = PeakMemoryUsage()
+        self.wall += wall
+        self.cpu  += cpu
+        return stage
+
+    @contextlib.contextmanager
+    def Stage(self, name, rows=0):
+        """
+        Context manager which times its block as (part of) stage name e.g.
+
+            with stats.Stage('sort', len(postcodes)):
+                postcodes.sort()
+
+        Yields the stage's record, so that rows not known at the start can be
+        added as stage['rows'] += rows.
+        """
+        stage   = self.Add(name, 0.0, 0.0, rows)
+        before  = (self.wall, self.cpu)             # Time recorded by nested stages
+        wall    = time.perf_counter()
+        cpu     = time.process_time()
+        try:
+            yield stage
+        finally:
+            wall = time.perf_counter() - wall - (self.wall - before[0])
+            cpu  = time.process_time() - cpu  - (self.cpu  - before[1])
+            self.Add(name, wall, cpu)
+
+    def AsDict(self):
+        """
+        Returns the statistics as a dictionary (as written by WriteJSON), with
+        each stage's rate in rows per second
+        """
+        end = self.end or (time.perf_counter(), time.process_time())
+        stages = collections.OrderedDict()
+        order  = {name: i for i, name in enumerate(self.STAGES)}
+        for name in sorted(self.stages, key=lambda name: (order.get(name, len(order)), name)):
+            stage = self.stages[name]
+            stages[name] = dict(stage, rows_per_second=stage['rows'] / stage['wall'] 
+                                                       if stage['wall'] else None)
+        return dict(self.info, success=self.success, stages=stages, 
+                    wall=end[0] - self.start[0], cpu=end[1] - self.start[1],
+                    peak_memory=PeakMemoryUsage())
+
+    def Finish(self, filename=None):
+        """
+        Ends the run, logs the statistics and, if filename is given, writes 
+        them to it as JSON (see WriteJSON).
+
+        Returns:
+            self
+        """
+        self.end = (time.perf_counter(), time.process_time())
+        self.LogStatistics()
+        if filename:
+            self.WriteJSON(filename)
+        return self
+
+    def WriteJSON(self, filename):
+        """
+        Writes the statistics to filename as JSON
+        """
+        import json
+        try:
+            with open(filename, 'w') as outfile:
+                json.dump(self.AsDict(), outfile, indent=2)
+            logger.info("Wrote metrics to {}".format(filename))
+        except (PermissionError, FileNotFoundError):
+            logger.error("Can't open {} for writing".format(filename))
+
+    def LogStatistics(self):
+        """
+        Logs the statistics of each stage
+        """
+        for name, stage in self.AsDict()['stages'].items():
+            logger.info("Stage {}: {:,} rows in {:.2f}s ({:.2f}s CPU, {:,.0f} rows/s){}"
+                         .format(name, stage['rows'], stage['wall'], stage['cpu'],
+                                 stage['rows_per_second'] or 0,
+                                 ", peak memory {:,.0f}MB".format(stage['peak_memory']/2**20)
+                                 if stage['peak_memory'] else ""))
+
+
+class Checkpoint:
+    """
+    Periodic record of how far a run has got through its input (the offset 
+    in the input file, the counts so far and how much output has been 
+    written) so that a run which dies can be resumed from where it got to,
+    to the same output as a run which didn't, rather than from row 1.
+
+    The record is a small JSON file, written to a temporary file which then
+    replaces the last one, after the output written so far has been flushed
+    to disk, so a checkpoint never claims more output than there is.
+
+    The input is read through Lines() rather than by iterating over the 
+    file, which leaves the file's tell() usable, and it is only ever 
+    checkpointed between rows, so seeking back to the offset on resuming 
+    picks up the next row. The size and modification time of the input are
+    recorded, and a checkpoint of a different input is ignored.
+    """
+    INTERVAL = 1000000                              # Default rows between checkpoints
+
+    def __init__(self, filename, input_name, interval=INTERVAL):
+        """
+        Parameters:
+            filename:   Name of the checkpoint file
+            input_name: Name of the input file
+            interval:   Number of rows between checkpoints
+        """
+        self.filename   = filename
+        self.input_name = input_name
+        self.interval   = interval
+        self.state      = {}
+        self.infile     = None
+        self.saved      = 0                         # Checkpoints written
+
+    def Identity(self):
+        """
+        Returns the size and modification time of the input file
+        """
+        stat = os.stat(self.input_name)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def Load(self, outputs=()):
+        """
+        Reads the checkpoint file in to state, provided it is a checkpoint
+        of the same input file
+
+        Parameters:
+            outputs: Names of the output files whose sizes were recorded (see
+                     Save), each of which must still be at least that size
+
+        Returns:
+            state: The state saved (as given to Save) or None if there is no
+                   usable checkpoint, in which case the run starts afresh
+        """
+        import json
+        try:
+            with open(self.filename) as infile:
+                state = json.load(infile)
+        except FileNotFoundError:
+            logger.warning("No checkpoint {} to resume from, so starting afresh"
+                           .format(self.filename))
+            return None
+        except ValueError:
+            logger.warning("Checkpoint {} is corrupt, so starting afresh".format(self.filename))
+            return None
+        if state.get('input') != [self.input_name] + self.Identity():
+            logger.warning("Checkpoint {} is of a different input, so starting afresh"
+                           .format(self.filename))
+            return None
+        for output, size in zip(outputs, state['outputs']):
+            if not os.path.isfile(output) or os.path.getsize(output) < size:
+                logger.warning("{} is shorter than checkpoint {} recorded, so starting afresh"
+                               .format(output, self.filename))
+                return None
+        self.state = state
+        logger.info("Resuming from checkpoint {} after {:,} rows".format(self.filename, 
+                                                                         state['rows']))
+        return state
+
+    def Lines(self, infile):
+        """
+        Returns an iterator over the lines of infile (a text file, e.g. for a
+        csv.reader) which, unlike iterating over infile itself, leaves 
+        infile.tell() usable, first seeking to the checkpoint's offset if
+        resuming
+        """
+        self.infile = infile
+        if self.state:
+            infile.seek(self.state['offset'])
+        return iter(infile.readline, '')
+
+    def Save(self, outfiles=(), **state):
+        """
+        Writes a checkpoint after the last row read from the input (which must
+        be being read through Lines).
+
+        Parameters:
+            outfiles: Output files whose size to record, which are flushed to
+                      disk first
+            state:    Anything else to record (e.g. the counts so far), which
+                      must include rows, the number of rows read
+        """
+        import json
+        state['offset'] = self.infile.tell()
+        state['outputs'] = []
+        for outfile in outfiles:
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            state['outputs'].append(outfile.tell())
+        state['input'] = [self.input_name] + self.Identity()
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as outfile:
+            json.dump(state, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temporary, self.filename)
+        self.state  = state
+        self.saved += 1
+
+    def Remove(self):
+        """
+        Removes the checkpoint file, once the run has finished
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.filename)
+        if self.saved:
+            logger.info("Wrote {:,} checkpoints to {}".format(self.saved, self.filename))
+
+
+def PeakMemoryUsage():
+    """
+    Returns the peak resident set size of the current process in bytes, or
+    None if it can't be determined (the resource module is Unix only).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports ru_maxrss in kilobytes, macOS in bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class SamplingProfiler:
+    """
+    A low overhead alternative to cProfile for long runs. Rather than 
+    recording every call, a background thread looks at the profiled thread's
+    stack every interval seconds and counts how often each stack is seen.
+
+    The stacks are written (see Dump) in the "collapsed" format read by 
+    flame graph tools (one line per stack: the functions, outermost first,
+    separated by semicolons, then the number of samples).
+
+    The background thread can only look when the interpreter lets it run,
+    which is mostly at the end of an iteration of a loop. So time spent in 
+    a function without a loop of its own (e.g. PostCode.__init__) tends to
+    be put down to the loop calling it: the sampler shows which loops the
+    time goes in, and cProfile can then show where within them.
+    """
+    INTERVAL = 0.005                                # Seconds between samples
+
+    def __init__(self, interval=INTERVAL):
+        """
+        Parameters:
+            interval: Seconds between samples
+        """
+        self.interval = interval
+        self.stacks   = collections.Counter()
+        self.samples  = 0
+        self.thread   = None
+
+    def enable(self):
+        """
+        Starts sampling the calling thread (named for cProfile.Profile's method)
+        """
+        import threading
+        self.target  = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread  = threading.Thread(target=self.Sample, name='SamplingProfiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def disable(self):
+        """
+        Stops sampling
+        """
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def Sample(self):
+        """
+        Runs in the background thread, counting the stacks until stopped
+        """
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def Dump(self, filename):
+        """
+        Writes the stacks seen to filename in the collapsed format
+        """
+        with open(filename, 'w') as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write("{} {}\n".format(';'.join(stack), count))
+
+    def Summary(self, top=20):
+        """
+        Returns a table of the top functions by the proportion of samples 
+        in which they were running themselves (self) and anywhere on the 
+        stack (total)
+        """
+        own   = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        lines = ["{:,} samples every {}s".format(self.samples, self.interval),
+                 "{:>7} {:>7}  function".format('self', 'total')]
+        for function, count in own.most_common(top):
+            lines.append("{:7.1%} {:7.1%}  {}".format(count / self.samples,
+                                                     total[function] / self.samples, function))
+        return "\n".join(lines)
+
+
+def RunProfiled(function, filename, sample=False, top=20):
+    """
+    Calls function() under cProfile, or a SamplingProfiler, writes what was
+    found to filename and logs a summary of the top hotspots.
+
+    Parameters:
+        function: Function (of no arguments) to call
+        filename: Name of the file to write the profile to: pstats format (for
+                  the pstats module, snakeviz etc.) with cProfile or collapsed
+                  stacks (for flame graphs) when sampling
+        sample:   If True sample the stack periodically rather than use cProfile, 
+                  which has a much lower overhead on long runs
+        top:      Number of functions in the summary
+
+    Returns:
+        Whatever function returned
+
+    Note:
+        Only the calling process is profiled, not any worker processes.
+    """
+    if sample:
+        profiler = SamplingProfiler()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function()
+    finally:
+        profiler.disable()
+        try:
+            if sample:
+                profiler.Dump(filename)
+                summary = profiler.Summary(top)
+            else:
+                import pstats
+                profiler.dump_stats(filename)
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats('tottime').print_stats(top)
+                summary = stream.getvalue().strip()
+            logger.info("Wrote profile to {}. Top {} functions:\n{}".format(filename, top, summary))
+        except (PermissionError, FileNotFoundError):
+            logger.error("Can't open {} for writing".format(filename))
+
+
+def FileChunks(filename, chunks):
+    """
+    Splits a CSV file in to byte ranges, aligned on line boundaries, so that
+    they can be validated in parallel (e.g. by a process pool)
     
+    Parameters:
+        filename: Name of the file, whose first line is a header
+        chunks:   Number of ranges to split it in to
+
+    Returns:
+        header: The header line (bytes)
+        ranges: List of (start, end) byte offsets, which between them cover
+                the whole file after the header. There may be fewer than
+                chunks of them if the file is small.
+
+    Notes:
+        A range starts at the beginning of a line and ends after a newline (or
+        at the end of the file) so no row is split between two ranges, unless
+        a quoted field contains a newline. Telling that newline from the end
+        of a row would mean parsing the whole file, so a file with any quote
+        (") in it, which is never the case for our extracts, is not split.
+    """
+    with open(filename, 'rb') as infile:
+        header = infile.readline()
+        size   = infile.seek(0, io.SEEK_END)
+        bounds = [len(header)]
+        if chunks > 1 and size > len(header):
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if mapped.find(b'"') >= 0:
+                    logging.warning("{} has quoted fields, which may have newlines in them, "
+                                    "so not splitting it in to chunks".format(filename))
+                    chunks = 1
+        for i in range(1, chunks):
+            infile.seek(max(bounds[0] + (size - bounds[0]) * i // chunks, bounds[-1]))
+            infile.readline()                       # Move on to the start of a line
+            if infile.tell() < size:
+                bounds.append(infile.tell())
+        bounds.append(size)
+    return header, [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def ReadChunk(filename, start, end, header=b''):
+    """
+    Returns a text stream, for e.g. a csv.reader, of the bytes from start to
+    end of filename (see FileChunks), preceded by header. It is decoded and
+    has its newlines translated just as open(filename) would, so the chunk 
+    is read exactly as it would be as part of the whole file.
+    """
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(header + data))
+
+
+# Compression formats we can read and write: module, magic bytes at the start
+# of the file and the usual file name suffix
+
+COMPRESSION = {'gzip': ('gzip', b'\x1f\x8b',         '.gz'),
+               'bz2':  ('bz2',  b'BZh',                '.bz2'),
+               'xz':   ('lzma', b'\xfd7zXZ\x00',       '.xz')}
+
+
+def DetectCompression(filename):
+    """
+    Returns the name of the compression format of filename ('gzip', 'bz2' or
+    'xz', see COMPRESSION), judged by its magic bytes rather than its name, 
+    or None if it isn't compressed
+    """
+    with open(filename, 'rb') as infile:
+        start = infile.read(6)
+    for name, (module, magic, suffix) in COMPRESSION.items():
+        if start.startswith(magic):
+            return name
+    return None
+
+
+def OpenInput(filename):
+    """
+    Opens filename for reading as text, just as open(filename) would, but 
+    decompressing it on the fly if it is compressed (see DetectCompression),
+    so that e.g. import_data.csv.gz needn't be decompressed to disk first
+    """
+    compression = DetectCompression(filename)
+    if compression is None:
+        return open(filename)
+    module = importlib.import_module(COMPRESSION[compression][0])
+    logger.info("Decompressing {} ({})".format(filename, compression))
+    return module.open(filename, 'rt')
+
+
+def CompressedFileName(filename, compression=None):
+    """
+    Returns filename with the usual suffix for compression (e.g. .gz, see 
+    COMPRESSION) added, unless it already ends with it or compression is None
+    """
+    if compression is None:
+        return filename
+    suffix = COMPRESSION[compression][2]
+    return filename if filename.endswith(suffix) else filename + suffix
+
+
+# Default size of the buffer of an output file (see OpenOutput)
+
+OUTPUT_BUFFER_SIZE = 2**20
+
+
+def OpenOutput(filename, compression=None, buffer_size=OUTPUT_BUFFER_SIZE, position=None):
+    """
+    Opens filename for writing as a CSV file, as open(filename, 'w', newline='')
+    would, but with a buffer of buffer_size bytes, or compressing the output if 
+    compression is one of COMPRESSION (see also CompressedFileName). If 
+    position is given the file is instead truncated to position bytes and
+    written from there on (to resume a run, see Checkpoint), which can't be
+    done to a compressed file.
+    """
+    if position is not None:
+        if compression is not None:
+            raise ValueError("Can't resume writing a compressed file")
+        outfile = open(filename, 'r+', newline='', buffering=buffer_size)
+        outfile.seek(position)
+        outfile.truncate()
+        return outfile
+    if compression is None:
+        return open(filename, 'w', newline='', buffering=buffer_size)
+    module = importlib.import_module(COMPRESSION[compression][0])
+    return module.open(filename, 'wt', newline='')
+
+
+def IsASCII(text):
+    """
+    Returns True if text is all ASCII. This is str.isascii(), which only 
+    looks at a flag in the str, where there is one (Python 3.7+).
+    """
+    return re.search(r'[^\x00-\x7f]', text) is None
+
+if hasattr(str, 'isascii'):
+    IsASCII = str.isascii
+
+
+class BlockWriter:
+    """
+    Writes CSV rows to an open file in blocks of many rows at a time, rather
+    than a line at a time, keeping count of the rows and bytes written and
+    the wall and CPU time spent writing them (see LogStatistics).
+
+    Rows are either lists (or, with fieldnames, dicts as for csv.DictWriter)
+    added with Write() or WriteRows(), which are formatted by csv a block at
+    a time, or (row_id, postcode) pairs added with WritePairs(), which are
+    formatted without csv at all where that gives the same output, or lines
+    which are already formatted, added with WriteLines().
+    """
+    BATCH_SIZE = 65536                              # Rows per block
+
+    def __init__(self, outfile, fieldnames=None, batch_size=BATCH_SIZE):
+        """
+        Parameters:
+            outfile:    Handle of the file to write to (opened before call)
+            fieldnames: If given, rows are dicts with these keys, as for csv.DictWriter
+            batch_size: Number of rows to format and write at a time
+        """
+        self.outfile    = outfile
+        self.encoding   = getattr(outfile, 'encoding', None) or 'utf-8'
+        self.ascii      = 'ascii'.encode(self.encoding) == b'ascii'   # A byte per ASCII character
+        self.block      = io.StringIO(newline='')
+        if fieldnames:
+            self.writer = csv.DictWriter(self.block, fieldnames=fieldnames)
+        else:
+            self.writer = csv.writer(self.block)
+        self.batch_size = batch_size
+        self.pending    = []
+        self.rows       = 0
+        self.bytes      = 0
+        self.seconds    = 0.0
+        self.cpu        = 0.0
+
+    def WriteBlock(self, text, rows=0):
+        """
+        Writes text, which is rows rows, straight to the file
+        """
+        start = time.perf_counter()
+        cpu   = time.process_time()
+        self.outfile.write(text)
+        self.rows    += rows
+        # Valid postcodes and row_ids are ASCII, so a block almost never has
+        # to be encoded a second time just to count its bytes
+        self.bytes   += len(text) if self.ascii and IsASCII(text) else len(text.encode(self.encoding))
+        self.seconds += time.perf_counter() - start
+        self.cpu     += time.process_time() - cpu
+
+    def FormatBlock(self, rows):
+        """
+        Formats a list of rows with the csv writer and writes them
+        """
+        start = time.perf_counter()
+        cpu   = time.process_time()
+        self.writer.writerows(rows)
+        text = self.block.getvalue()
+        self.block.seek(0)
+        self.block.truncate()
+        self.seconds += time.perf_counter() - start
+        self.cpu     += time.process_time() - cpu
+        self.WriteBlock(text, len(rows))
+
+    def WriteHeader(self, header=('row_id', 'postcode')):
+        """
+        Writes the header row: the fieldnames, if given, else header
+        """
+        if isinstance(self.writer, csv.DictWriter):
+            self.writer.writeheader()
+        else:
+            self.writer.writerow(header)
+        text = self.block.getvalue()
+        self.block.seek(0)
+        self.block.truncate()
+        self.WriteBlock(text)
+
+    def Write(self, row):
+        """
+        Adds a single row, which is written once there is a block's worth
+        """
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.Flush()
+
+    def Flush(self):
+        """
+        Writes any rows added with Write() which haven't been written yet
+        """
+        if self.pending:
+            self.FormatBlock(self.pending)
+            self.pending = []
+
+    def WriteRows(self, rows):
+        """
+        Writes an iterable of rows, a block at a time
+        """
+        self.Flush()
+        rows  = iter(rows)
+        block = list(islice(rows, self.batch_size))
+        while block:
+            self.FormatBlock(block)
+            block = list(islice(rows, self.batch_size))
+
+    def WriteLines(self, lines):
+        """
+        Writes an iterable of lines of text, already formatted (newlines and
+        all), a block at a time
+        """
+        self.Flush()
+        lines = iter(lines)
+        block = list(islice(lines, self.batch_size))
+        while block:
+            self.WriteBlock(''.join(block), len(block))
+            block = list(islice(lines, self.batch_size))
+
+    def WritePairs(self, pairs):
+        """
+        Writes (row_id, postcode) pairs, a block at a time, exactly as the csv 
+        writer would.
+
+        Notes:
+            Formatting a block of pairs with str.format and a join is much
+            faster than the csv writer. The output is only the same if no field
+            needs quoting (has a comma, quote or newline in it) and no row_id
+            is None (which str.format turns in to "None" rather than ""). We
+            check that for a whole block at a time with a few (very fast)
+            str.count calls: "None," can only come from a None row_id or from
+            a postcode with a comma in it. Any block which fails the check is
+            formatted with the csv writer instead.
+        """
+        self.Flush()
+        line  = '{},{}\r\n'.format
+        pairs = iter(pairs)
+        while True:
+            start = time.perf_counter()
+            cpu   = time.process_time()
+            block = list(islice(pairs, self.batch_size))
+            if not block:
+                break
+            text  = ''.join(starmap(line, block))
+            lines = len(block)
+            self.seconds += time.perf_counter() - start
+            self.cpu     += time.process_time() - cpu
+            if 'None,' in text or '"' in text or text.count(',') != lines or \
+               text.count('\n') != lines or text.count('\r') != lines:
+                self.FormatBlock(block)
+            else:
+                self.WriteBlock(text, lines)
+
+    def LogStatistics(self, filename):
+        """
+        Logs the rows and bytes (before any compression) written to filename
+        and how fast they were written
+        """
+        rate = self.bytes / self.seconds if self.seconds else 0
+        logger.info("Wrote {:,} rows ({:,} bytes) to {} in {:.2f}s ({:,.1f}MB/s)"
+                     .format(self.rows, self.bytes, filename, self.seconds, rate/2**20))
+
+
+class PostCodeReader:
+    """
+    Fast reader for plain (uncompressed) row_id,postcode files.
+
+    Rather than decoding the whole file and having csv split every line in
+    to fields, the file is memory mapped and matched, as bytes, against
+    LineRE: a whole row_id,postcode line whose postcode validates. Runs of
+    lines which match never become str objects unless they have to. Anything
+    else (invalid postcodes, quoting, blank lines and the like) is read by
+    csv, exactly as csv.reader(open(filename)) would read it, and validated
+    as PostCode would validate it. So the rows and statuses are the same as
+    reading the file with csv, but the bulk of the work is done in C.
+
+    Iterating over the reader yields (row, status) for each row after the
+    header, skipping blank rows as csv.DictReader does. row is the list of
+    fields, as from csv.reader, and status is a PCValidationCodes value, or
+    None if the row has no postcode field. span is then the (start, end) byte
+    offsets of the row in the file. With valid=False the rows which
+    LineRE matches (the valid ones) aren't yielded at all but only counted,
+    which is all Part 2 needs.
+
+    Use Open() rather than the constructor, as it checks that the file is
+    one we can read this way.
+    """
+    FIELDNAMES = ['row_id', 'postcode']
+
+    # The ASCII characters which \s matches in a str RE, other than the
+    # newlines. FastRE in bytes, with \s as these and \S as the printable
+    # ASCII characters other than the comma and the quote, only matches
+    # postcodes which FastRE matches as str: anything else (e.g. non-ASCII
+    # text, which str REs would treat differently) is left for the slow path.
+
+    WHITESPACE = r'[ \t\x0b\x0c\x1c-\x1f]'
+    PRINTABLE  = r'[!#-+\--~]'
+    PostCodeREString = PostCode.FastREString.replace(r'\s*\Z', WHITESPACE + '*') \
+                                            .replace(r'\S',    PRINTABLE) \
+                                            .replace(r'\s',    WHITESPACE)
+    LineREString = r'^(?P<row_id>[^,"\r\n\x00\x80-\xff]*),(?P<postcode>' + PostCodeREString + r')\r?$'
+    LineRE = LazyRE(LineREString.encode('ascii'), re.VERBOSE | re.MULTILINE)
+    RunRE  = LazyRE(r'(?:{}(?:\n|\Z))+'.format(LineREString[:-1]).encode('ascii'), 
+                    re.VERBOSE | re.MULTILINE)
+    NewLineRE = LazyRE(rb'\r\n?|\n')
+
+    def __init__(self, filename, analyse=False, engine=PCValidationEngines.REGEX, 
+                 cache=None, valid=True):
+        """
+        Parameters:
+            filename: Name of the file to read
+            analyse:  As for PostCode, for the rows validated on the slow path
+            engine:   As for PostCode
+            cache:    As for PostCode
+            valid:    If False, don't yield the rows which LineRE matches
+        """
+        import locale
+        self.filename  = filename
+        self.analyse   = analyse
+        self.engine    = engine
+        self.classify  = PostCode.Classify if cache is None else cache.Classify
+        self.valid     = valid
+        self.encoding  = locale.getpreferredencoding(False)  # As open() uses
+        self.rows      = 0                          # Rows read (other than blank ones)
+        self.fast_rows = 0                          # ... of which matched LineRE
+        self.file      = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:                          # An empty file can't be mapped
+            self.data = b''
+        self.position   = 0
+        self.fieldnames = next(self.CsvRows(0, 0), None)
+        self.start      = self.position
+
+    @classmethod
+    def Open(cls, filename, **kwargs):
+        """
+        Returns a PostCodeReader for filename (see the constructor for kwargs),
+        or None if the file can't be read this way: if it is compressed, if its
+        encoding isn't a superset of ASCII or if its header isn't row_id,postcode.
+        The file should then be read with csv as usual.
+        """
+        import locale
+        if DetectCompression(filename):
+            return None
+        try:
+            compatible = b'\r\n,"'.decode(locale.getpreferredencoding(False)) == '\r\n,"'
+        except UnicodeDecodeError:
+            compatible = False
+        if compatible:
+            try:
+                reader = cls(filename, **kwargs)
+            except UnicodeDecodeError:              # Let csv report the error
+                return None
+            if reader.fieldnames == cls.FIELDNAMES:
+                return reader
+            reader.Close()
+        logger.info("Can't read {} with PostCodeReader".format(filename))
+        return None
+
+    def Close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Close()
+
+    def Lines(self, position):
+        """
+        Yields the lines of the file from byte position on, decoded and with
+        their newlines translated just as open(filename) would. self.position
+        is the end of the last line yielded.
+        """
+        data   = self.data
+        size   = len(data)
+        search = self.NewLineRE.search
+        while position < size:
+            newline = search(data, position)
+            if newline:
+                line = data[position:newline.start()].decode(self.encoding) + '\n'
+                position = newline.end()
+            else:
+                line = data[position:size].decode(self.encoding)
+                position = size
+            self.position = position
+            yield line
+
+    def CsvRows(self, start, end):
+        """
+        Yields the rows csv.reader would read from the file from byte start on,
+        stopping after the row which takes us to (or past) byte end. self.position
+        is then the end of the last row.
+        """
+        self.position = start
+        for row in csv.reader(self.Lines(start)):
+            self.span = (start, self.position)
+            start = self.position
+            yield row
+            if self.position >= end:
+                return
+
+    def SplitRows(self, lines, start):
+        """
+        Yields the rows of lines (bytes, from byte start of the file), as
+        CsvRows() would, for lines with no quotes (or NULs) in them, for which
+        csv would simply split each line on the commas
+        """
+        for line in lines.splitlines(True):         # Splits on \r, \n and \r\n as open() does
+            end = start + len(line)
+            self.span     = (start, end)
+            self.position = start = end
+            text = line.decode(self.encoding).rstrip('\r\n')
+            yield text.split(',') if text else []
+
+    def SlowRows(self, start, end):
+        """
+        Yields (row, status) for the rows from byte start on, as CsvRows() does
+        (or, if it can, SplitRows()), validating them as PostCode would and
+        skipping blank rows
+        """
+        classify = self.classify
+        analyse, engine = self.analyse, self.engine
+        lines = self.data[start:end]
+        if b'"' in lines or b'\x00' in lines:
+            rows = self.CsvRows(start, end)
+        else:
+            rows = self.SplitRows(lines, start)
+        for row in rows:
+            if row:
+                self.rows += 1
+                if len(row) > 1:
+                    yield row, classify(row[1], analyse, engine)[0]
+                else:
+                    yield row, None
+
+    def Line(self):
+        """
+        Returns the original text of the row last yielded, exactly as it is in
+        the file (quoting, newline and all). A newline is added if it is the
+        last line of the file and hasn't got one.
+        """
+        line = self.data[self.span[0]:self.span[1]].decode(self.encoding)
+        return line if line.endswith(('\n', '\r')) else line + self.NewLine()
+
+    def Header(self):
+        """
+        Returns the original text of the header line, as Line() does
+        """
+        return self.data[:self.start].decode(self.encoding)
+
+    def NewLine(self):
+        """
+        Returns the newline with which the header line ends
+        """
+        header = self.data[:self.start]
+        for newline in ('\r\n', '\n', '\r'):
+            if header.endswith(newline.encode('ascii')):
+                return newline
+        return '\r\n'
+
+    def ReadLines(self):
+        """
+        Reads every row, as iterating over the reader does, in to a LineBatch
+        holding each row's original line (see Line())
+        """
+        data, size = self.data, len(self.data)
+        batch    = LineBatch(data[:self.start], self.encoding, self.NewLine().encode('ascii'))
+        position = self.start
+        search   = self.RunRE.search
+        while position < size:                      # As __iter__, but a run of 
+            match = search(data, position)          # valid lines at a time
+            start = match.start() if match else size
+            if start > position:
+                for row, status in self.SlowRows(position, start):
+                    batch.AppendLine(data[self.span[0]:self.span[1]], row[0], status)
+                position = self.position
+                if position > start:
+                    continue
+            if match is None:
+                break
+            self.fast_rows += batch.AppendRun(match.group())
+            position = match.end()
+        self.rows += self.fast_rows
+        return batch
+
+    def __iter__(self):
+        data, size = self.data, len(self.data)
+        position = self.start
+        search   = (self.LineRE if self.valid else self.RunRE).search
+        while position < size:
+            match = search(data, position)
+            start = match.start() if match else size
+            if start > position:                    # Lines LineRE didn't match
+                yield from self.SlowRows(position, start)
+                position = self.position
+                if position > start:                # A quoted field ran on past the 
+                    continue                        # start of the match
+            if match is None:
+                break
+            if self.valid:
+                row_id, postcode = match.group('row_id', 'postcode')
+                self.rows      += 1
+                self.fast_rows += 1
+                position  = match.end() + 1         # Past the newline
+                self.span = (start, position)
+                yield [row_id.decode('ascii'), postcode.decode('ascii')], _OK
+            else:
+                run   = match.group()
+                lines = run.count(b'\n') + (not run.endswith(b'\n'))
+                self.rows      += lines
+                self.fast_rows += lines
+                position = match.end()
+
+
 if __name__ == '__main__':
-    
-    pass
\ No newline at end of file
+    """
+    Compiles a reference list of the postcodes which exist in to a gazetteer
+    index (see Gazetteer) for the --gazetteer option of Parts 2 and 3.
+
+    Command line arguments:
+        --reference: CSV file of the postcodes which exist (which may be compressed)
+        --column:    Name of its column of postcodes
+        --gazetteer: Gazetteer index file to write
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile a gazetteer of the postcodes which exist")
+    parser.add_argument("--reference",
+                        help="CSV file of the postcodes which exist (which may be gzip, bz2 or "
+                             "xz compressed), e.g. the ONS Postcode Directory", 
+                        required=True)
+    parser.add_argument("--column",
+                        help="Name of the reference file's column of postcodes",
+                        default="postcode")
+    parser.add_argument("--gazetteer",
+                        help="Gazetteer index file to write",
+                        default="gazetteer.index")
+    args = parser.parse_args()
+    logging.basicConfig(stream = sys.stdout, level = logging.DEBUG, 
+                format = '%(asctime)s:%(levelname)s:%(message)s')
+    with OpenInput(args.reference) as infile:
+        reader = csv.DictReader(infile)
+        if args.column not in (reader.fieldnames or []):
+            sys.exit("{} has no {} column".format(args.reference, args.column))
+        Gazetteer.Compile((row[args.column] for row in reader), args.gazetteer)
@@ -118,7 +118,42 @@ Expected Results
 """
 
 import unittest
-from NHSPostCode import PostCode, PCValidationCodes
+import io
+import json
+import pstats
+import re
+import subprocess
+import sys
+import os
+import csv
+import random
+import tempfile
+import threading
+from itertools import product
+from unittest import mock
+from NHSPostCode import PostCode, PostCodeRecord, PostCodeBatch, PostCodeTable, ValidationCache
+from NHSPostCode import FileChunks, ReadChunk, COMPRESSION, DetectCompression
+from NHSPostCode import OpenInput, OpenOutput, CompressedFileName, PostCodeReader, BlockWriter
+from NHSPostCode import RunStatistics, RunProfiled, LazyRE, ValidateMany, FingerprintIndex
+from NHSPostCode import Gazetteer
+from NHSPostCode import PCValidationCodes, PCValidationEngines
+from NHSTechnicalTestPart3 import SortOrder, SortPostCodeList, SplitAndSortPostCodeList
+from NHSTechnicalTestPart3 import DenseRowIds, PlaceByRowId, ValidateInParallel
+from NHSTechnicalTestPart3 import StreamPostCodes, ExternalSortPostCodes, WriteRun
+from NHSTechnicalTestPart2 import ProcessFiles, ProcessFilesInParallel, ProcessMappedFile
+from NHSTechnicalTestPart2 import ProcessFilesPipelined
+from NHSTechnicalTestPart2 import PerformTests as PerformPart2
+from NHSTechnicalTestPart3 import PerformTests as PerformPart3
+from NHSBenchmarks import RandomValidPostCode, RandomInvalidPostCode, FAILURE_CLASSES
+
+# All of the test case postcodes above, for tests which compare alternative
+# ways of validating postcodes against the PostCode class
+
+ALL_POSTCODES = ['$%± ()()', 'XX XXX',   'A1 9A',    'LS44PL',   'Q1A 9AA',
+                 'V1A 9AA',  'X1A 9BB',  'LI10 3QP', 'LJ10 3QP', 'LZ10 3QP',
+                 'A9Q 9AA',  'AA9C 9AA', 'FY10 4PL', 'SO1 4QQ',  'EC1A 1BB',
+                 'W1A 0AX',  'M1 1AE',   'B33 8TH',  'CR2 6XH',  'DN55 1PT',
+                 'GIR 0AA',  'SO10 9AA', 'FY9 9AA',  'WC1A 9AA']
 
 class PostCodeTest(unittest.TestCase):
     """
@@ -252,7 +287,930 @@ class PostCodeTest(unittest.TestCase):
         postcode = 'LS44PL'
         p = PostCode(postcode, analyse=True)
         self.assertEqual(p.status, PCValidationCodes.INCORRECT_GROUPING)
-        
+
+
+class PostCodeRecordTest(unittest.TestCase):
+    """
+    Tests that the compact PostCodeRecord validates exactly as PostCode does
+    """
+
+    def test_status_matches_postcode(self):
+        """
+        Every test case should get the same status (with and without analysis)
+        """
+        for analyse in [True, False]:
+            for postcode in ALL_POSTCODES:
+                r = PostCodeRecord(postcode, '1', analyse=analyse)
+                self.assertEqual(r.status, PostCode(postcode, analyse=analyse).status)
+                self.assertEqual(r.row_id, 1)
+
+    def test_parts(self):
+        """
+        The outward and inward parts are only kept when asked for
+        """
+        r = PostCodeRecord('M1 1AE')
+        self.assertIsNone(r.outward)
+        self.assertIsNone(r.inward)
+        r = PostCodeRecord('M1 1AE', keep_parts=True)
+        self.assertEqual((r.outward, r.inward), ('M1', '1AE'))
+        self.assertFalse(hasattr(r, '__dict__'))
+
+    def test_round_trip(self):
+        """
+        Records can be built from, and converted back to, PostCode objects
+        """
+        p = PostCode('FY10 4PL', 7, analyse=True)
+        r = PostCodeRecord.FromPostCode(p)
+        self.assertEqual((r.postcode, r.row_id, r.status), (p.postcode, p.row_id, p.status))
+        self.assertEqual(r.ToPostCode(analyse=True).status, PCValidationCodes.SINGLE_DIGIT_DISTRICT)
+
+
+class PostCodeBatchTest(unittest.TestCase):
+    """
+    Tests the columnar PostCodeBatch container
+    """
+
+    def setUp(self):
+        # Reverse the row_ids so that sorting has something to do, and
+        # include a row without a usable row_id
+        rows = [(str(len(ALL_POSTCODES) - i), p) for i, p in enumerate(ALL_POSTCODES)]
+        rows.append(('', 'M1 7EP'))
+        self.batch = PostCodeBatch(rows)
+
+    def test_validate(self):
+        """
+        Statuses should match PostCode's with and without analysis
+        """
+        self.assertIsNone(self.batch.Status(0))
+        for analyse in [True, False]:
+            self.batch.Validate(analyse)
+            for row_id, postcode, status in self.batch:
+                self.assertEqual(status, PostCode(postcode, analyse=analyse).status)
+
+    def test_filter_and_sort(self):
+        """
+        Filtering splits the batch by status and sorting puts it in to row_id
+        order with missing row_ids last
+        """
+        self.batch.Validate()
+        good = self.batch.Filter(PCValidationCodes.OK).SortByRowId()
+        bad  = self.batch.Filter(PCValidationCodes.OK, invert=True).SortByRowId()
+        self.assertEqual(len(good) + len(bad), len(self.batch))
+        self.assertEqual([r[1] for r in good],
+                         ['WC1A 9AA', 'FY9 9AA', 'SO10 9AA', 'GIR 0AA', 'DN55 1PT',
+                          'CR2 6XH', 'B33 8TH', 'M1 1AE', 'W1A 0AX', 'EC1A 1BB', 'M1 7EP'])
+        self.assertEqual(good.RowId(len(good) - 1), None)
+        self.assertEqual(bad.PostCode(0), 'SO1 4QQ')
+
+    def test_write(self):
+        """
+        The CSV output should be the same as writing the rows with a csv.writer
+        """
+        outfile = io.StringIO()
+        self.batch.WriteCSV(outfile)
+        self.assertTrue(outfile.getvalue().startswith('row_id,postcode\r\n24,$%± ()()\r\n'))
+        self.assertTrue(outfile.getvalue().endswith('1,WC1A 9AA\r\n,M1 7EP\r\n'))
+
+    def test_huge_row_id(self):
+        """
+        A row_id too big for the row_ids array counts as no row_id, so Part 3
+        handles it in the modes which use batches
+        """
+        batch = PostCodeBatch([('99999999999999999999', 'M1 1AE'), ('1', 'B1 1AA'),
+                               (str(-2**63), 'W1A 0AX')])
+        self.assertEqual([row[0] for row in batch], [None, 1, None])
+        with tempfile.TemporaryDirectory() as directory:
+            File = lambda name: os.path.join(directory, name)
+            with open(File('input.csv'), 'w', newline='') as outfile:
+                outfile.write('row_id,postcode\r\n99999999999999999999,M1 1AE\r\n1,B1 1AA\r\n')
+            for mode in [{'UseBatch': True}, {'Workers': 2}]:
+                PerformPart3(File('input.csv'), File('m.csv'), File('u.csv'), **mode)
+                with open(File('m.csv'), newline='') as infile:
+                    self.assertEqual(infile.read(), 'row_id,postcode\r\n1,B1 1AA\r\n,M1 1AE\r\n', mode)
+
+
+def ExhaustivePostCodes():
+    """
+    Generates candidate postcodes for checking alternative validation engines
+    against the RE:
+
+    1. Every outward code of up to 4 letters and digits with a valid inward code
+    2. Every inward code of 3 letters and digits with various outward codes
+    3. Assorted separators (including unusual whitespace), truncations,
+       trailing junk and lowercase versions of all of the test cases
+    """
+    alphanumerics = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    for length in range(1, 5):
+        for outward in product(alphanumerics, repeat=length):
+            yield "".join(outward) + " 9AA"
+    for outward in ['M1', 'B33', 'CR2', 'DN55', 'EC1A', 'W1A', 'WC1', 'GIR', 'AB1']:
+        for inward in product(alphanumerics, repeat=3):
+            yield outward + " " + "".join(inward)
+    separators = [' ', '\t', '\n', '\x0b', '\x1c', '\x85', '\xa0', '\u2028', '\u3000',
+                  '', '  ', '_', '-']
+    for postcode in ALL_POSTCODES:
+        outward, _, inward = postcode.rpartition(' ')
+        for separator in separators:
+            candidate = outward + separator + inward
+            for i in range(len(candidate) + 1):
+                yield candidate[:i]
+            yield candidate + "JUNK"
+            yield candidate + " JUNK"
+            yield " " + candidate
+            yield candidate.lower()
+
+
+class ValidateManyTest(unittest.TestCase):
+    def test_same_as_postcode(self):
+        """
+        ValidateMany gives the same statuses as PostCode, whatever the engine,
+        cache and block size, and with or without analysis
+        """
+        postcodes = ALL_POSTCODES + ['M1 7EP X', 'M1 7EP ', ' M1 7EP', 'GIR 0AA', '']
+        for analyse, engine, cache, block_size in product([False, True], PCValidationEngines,
+                                                          [None, ValidationCache(4)], [1, 7, 100]):
+            expected = [PostCode(p, analyse=analyse, engine=engine).status.value for p in postcodes]
+            statuses = ValidateMany(iter(postcodes), analyse, engine, cache, block_size)
+            self.assertEqual(statuses.typecode, 'b')
+            self.assertEqual(list(statuses), expected)
+
+class PostCodeTableTest(unittest.TestCase):
+    """
+    Tests that the table-driven PostCodeTable gives exactly the same
+    results as the specified RE
+    """
+
+    def test_exhaustive_equivalence(self):
+        """
+        Every generated candidate should be accepted or rejected by both
+        """
+        for candidate in ExhaustivePostCodes():
+            self.assertEqual(PostCodeTable.Match(candidate),
+                             bool(PostCode.RE.match(candidate)), repr(candidate))
+
+    def test_status_matches_regex(self):
+        """
+        PostCode should give the same status whichever engine is used
+        """
+        for analyse in [True, False]:
+            for postcode in ALL_POSTCODES:
+                p = PostCode(postcode, analyse=analyse, engine=PCValidationEngines.TABLE)
+                self.assertEqual(p.status, PostCode(postcode, analyse=analyse).status)
+
+
+class SingleMatchTest(unittest.TestCase):
+    """
+    Tests that single match mode (PCValidationEngines.SINGLE_MATCH) gives
+    exactly the same results as splitting and then matching against the RE
+    """
+
+    def test_exhaustive_equivalence(self):
+        """
+        Status, outward and inward parts should be the same for every
+        generated candidate
+        """
+        for candidate in ExhaustivePostCodes():
+            self.assertEqual(PostCode.Classify(candidate, engine=PCValidationEngines.SINGLE_MATCH),
+                             PostCode.Classify(candidate), repr(candidate))
+
+    def test_status_matches_regex(self):
+        """
+        PostCode should give the same status and parts in single match mode
+        """
+        for analyse in [True, False]:
+            for postcode in ALL_POSTCODES + ['M1 1AE ', 'M1 1AEX', 'M1 1AE X', 'M1\t1AE']:
+                p = PostCode(postcode, analyse=analyse, engine=PCValidationEngines.SINGLE_MATCH)
+                q = PostCode(postcode, analyse=analyse)
+                self.assertEqual((p.status, p.outward, p.inward), (q.status, q.outward, q.inward))
+
+
+class ValidationCacheTest(unittest.TestCase):
+    """
+    Tests the LRU ValidationCache
+    """
+
+    def test_results_match_postcode(self):
+        """
+        Cached results should be exactly the same as uncached ones, whether
+        or not they come from the cache
+        """
+        cache = ValidationCache(100)
+        for repeat in range(2):
+            for analyse in [True, False]:
+                for postcode in ALL_POSTCODES:
+                    p = PostCode(postcode, analyse=analyse, cache=cache)
+                    q = PostCode(postcode, analyse=analyse)
+                    self.assertEqual((p.status, p.outward, p.inward), (q.status, q.outward, q.inward))
+        info = cache.Info()
+        self.assertEqual((info.hits, info.misses), (2 * len(ALL_POSTCODES), 2 * len(ALL_POSTCODES)))
+        self.assertEqual(cache.HitRate(), 0.5)
+
+    def test_eviction(self):
+        """
+        The least recently used entry is evicted when the cache is full
+        """
+        cache = ValidationCache(2)
+        for postcode in ['M1 1AE', 'B33 8TH', 'M1 1AE', 'CR2 6XH', 'M1 1AE', 'B33 8TH']:
+            PostCodeRecord(postcode, cache=cache)
+        info = cache.Info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 4, 2))
+
+class SortOrderTest(unittest.TestCase):
+    """
+    Tests of skipping the sort when the input is already in row_id order
+    """
+    def test_paths(self):
+        self.assertEqual(SortOrder([1, 2, 3, 5]), 'presorted')
+        self.assertEqual(SortOrder([1, 2, 2, 5]), 'unsorted')  # Ties are ordered by postcode
+        self.assertEqual(SortOrder(list(range(100)) + [50] + list(range(101, 200))), 'nearly sorted')
+        self.assertEqual(SortOrder([3, 1, 2, 0]), 'unsorted')
+        self.assertEqual(SortOrder([1, None, 2]), 'unsorted')
+
+    def test_paths_per_run(self):
+        """
+        Each run of Part 3 counts only its own sort paths
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            File = lambda name: os.path.join(directory, name)
+            with open(File('input.csv'), 'w', newline='') as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(['row_id', 'postcode'])
+                writer.writerows(enumerate(ALL_POSTCODES, 1))
+            for run in range(2):
+                stats = PerformPart3(File('input.csv'), File('m.csv'), File('u.csv'))
+                self.assertEqual(stats.info['sort_paths'], {'presorted': 2})
+
+    def test_place_by_row_id(self):
+        """
+        Rows are placed directly only when the row_ids are dense and unique:
+        DenseRowIds only checks the range, PlaceByRowId finds duplicates
+        """
+        records = lambda row_ids: [PostCodeRecord('M1 1AE', row_id) for row_id in row_ids]
+        self.assertEqual(DenseRowIds(records([3, 1, 4, 2])), (1, 4))
+        self.assertEqual(DenseRowIds(PostCodeBatch(zip([3, 1, 4, 2], 'abcd'))), (1, 4))
+        self.assertIsNone(DenseRowIds(records([3, 1, 5, 2])))     # Gap
+        self.assertIsNone(DenseRowIds(records([3, 1, None, 2])))  # Missing
+        self.assertIsNone(DenseRowIds(PostCodeBatch(zip([3, 1, None, 2], 'abcd'))))
+        self.assertIsNone(DenseRowIds([]))
+        self.assertIsNone(DenseRowIds(records([None])))           # A single row without a row_id
+        self.assertEqual(list(map(len, SplitAndSortPostCodeList(records([None])))), [1, 0])
+        self.assertEqual(DenseRowIds(records([1, 1, 3])), (1, 3))
+        self.assertEqual(DenseRowIds(records([1, 2, -1, 0])), (-1, 2))
+        self.assertEqual(PlaceByRowId(['c', 'a', 'd', 'b'], [3, 1, 4, 2], 1, 4), ['a', 'b', 'c', 'd'])
+        self.assertEqual(PlaceByRowId(['c', 'a'], [1003, 1001], 1001, 1004), ['a', 'c'])
+        with self.assertLogs(level='INFO') as logs:
+            self.assertIsNone(PlaceByRowId(['c', 'a', 'd'], [3, 1, 3], 1, 3))  # Duplicate
+        self.assertIn('comparison sort', logs.output[0])
+        self.assertEqual(PlaceByRowId(['c', 'd', 'a', 'b'], [1, 2, -1, 0], -1, 2), ['a', 'b', 'c', 'd'])
+        self.assertEqual(PlaceByRowId(['c', 'b', 'a'], [-2, -3, -4], -4, -2), ['a', 'b', 'c'])
+
+    def test_split_and_sort(self):
+        """
+        Presorted or not, records and batches come out in row_id order, 
+        whatever the sign of the row_ids
+        """
+        shuffled = list(range(-12, 12))
+        random.Random(0).shuffle(shuffled)
+        for row_ids in [range(1, 25), reversed(range(1, 25)), range(1, 49, 2), 
+                        [1, 2, -1, 0], [-2, -3, -4], shuffled]:
+            rows = list(zip(row_ids, ALL_POSTCODES))
+            records = [PostCodeRecord(postcode, row_id) for row_id, postcode in rows]
+            batch = PostCodeBatch(rows)
+            batch.Validate()
+            for results in [SplitAndSortPostCodeList(records), SplitAndSortPostCodeList(batch)]:
+                self.assertEqual(sum(map(len, results)), len(rows))
+                for result in results:
+                    row_ids = [row[0] for row in result] if isinstance(result, PostCodeBatch) \
+                              else [record.row_id for record in result]
+                    self.assertEqual(row_ids, sorted(row_ids))
+
+    def test_sort_key(self):
+        """
+        Ordering is defined for every row: a row_id of 0 is like any other, 
+        rows without a row_id go last and ties are broken on the postcode
+        """
+        rows = [(5, 'B1 1AA'), (None, 'B1 1AA'), (0, 'Z1 1AA'), (5, 'A1 1AA'), 
+                (None, 'A1 1AA'), (2, 'M1 1AA')]
+        expected = [(0, 'Z1 1AA'), (2, 'M1 1AA'), (5, 'A1 1AA'), (5, 'B1 1AA'),
+                    (None, 'A1 1AA'), (None, 'B1 1AA')]
+        for cls in [PostCode, PostCodeRecord]:
+            postcodes = [cls(postcode, row_id) for row_id, postcode in rows]
+            SortPostCodeList(postcodes)
+            self.assertEqual([(p.row_id, p.postcode) for p in postcodes], expected)
+            self.assertEqual([(p.row_id, p.postcode) for p in sorted(postcodes)], expected)
+
+    def test_ties_in_every_mode(self):
+        """
+        Every mode of Part 3 breaks ties between row_ids on the postcode, 
+        including the external sort, with ties split between runs of 2 rows
+        which are merged in more than one pass
+        """
+        rows = [(1, 'M2 1AE'), (1, 'M1 1AE'), (2, 'M1 1AE'), (3, 'XX'), (3, 'AA'), (1, 'B1 1AA')]
+        modes = [{}, {'Stream': True}, {'UseBatch': True}, {'PassThrough': True},
+                 {'MaxMemory': 1}, {'Workers': 2}]
+        with tempfile.TemporaryDirectory() as directory:
+            File = lambda name: os.path.join(directory, name)
+            with open(File('input.csv'), 'w', newline='') as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(['row_id', 'postcode'])
+                writer.writerows(rows)
+            for mode in modes:
+                with mock.patch('NHSTechnicalTestPart3.RunRows', return_value=2), \
+                     mock.patch('NHSTechnicalTestPart3.MERGE_WIDTH', 2), \
+                     mock.patch('NHSTechnicalTestPart3.WriteRun', wraps=WriteRun) as write:
+                    PerformPart3(File('input.csv'), File('m.csv'), File('u.csv'), **mode)
+                self.assertEqual(write.call_count > 3, 'MaxMemory' in mode, mode)
+                with open(File('m.csv')) as matched, open(File('u.csv')) as unmatched:
+                    self.assertEqual(list(csv.reader(matched))[1:],
+                                     [['1', 'B1 1AA'], ['1', 'M1 1AE'], ['1', 'M2 1AE'], ['2', 'M1 1AE']], mode)
+                    self.assertEqual(list(csv.reader(unmatched))[1:], [['3', 'AA'], ['3', 'XX']], mode)
+
+    def test_external_sort(self):
+        """
+        Sorting in runs spilled to disk, and merging them (in more than one 
+        pass), gives the same result as sorting in memory
+        """
+        rows = [[str(row_id), postcode] for row_id, postcode in 
+                zip([7, 3, 'x', 3, 0, 12, 5, 'x', 9, 1, 2] * 3, ALL_POSTCODES)]
+        expected = StreamPostCodes(iter(rows))
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch('NHSTechnicalTestPart3.RunRows', return_value=4), \
+                 mock.patch('NHSTechnicalTestPart3.MERGE_WIDTH', 2):
+                results = ExternalSortPostCodes(iter(rows), directory, 0)
+                self.assertEqual([list(result) for result in results], list(expected))
+            self.assertEqual(ExternalSortPostCodes(iter(rows), directory, 2**30), expected)
+
+class ChunkTest(unittest.TestCase):
+    """
+    Tests of validating a file in chunks in worker processes
+    """
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['row_id', 'postcode'])
+            writer.writerows(enumerate(ALL_POSTCODES * 10, 1))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_chunks(self):
+        """
+        The chunks cover the file after the header line, splitting it only
+        between lines
+        """
+        header, chunks = FileChunks(self.filename, 7)
+        self.assertEqual(header, b'row_id,postcode\r\n')
+        self.assertEqual(len(chunks), 7)
+        text = "".join(ReadChunk(self.filename, start, end).read() for start, end in chunks)
+        with open(self.filename) as infile:
+            self.assertEqual(header.decode().replace('\r', '') + text, infile.read())
+        for start, end in chunks:
+            self.assertTrue(ReadChunk(self.filename, start, end).read().endswith('\n'))
+        self.assertEqual(len(FileChunks(self.filename, 1000)[1]), len(ALL_POSTCODES) * 10)
+
+    def test_parallel(self):
+        """
+        Output is exactly the same as when the file is processed in one go, 
+        even if a quoted field has a newline in it
+        """
+        quoted = self.filename + '.quoted'
+        with open(quoted, 'w', newline='') as outfile:
+            outfile.write('row_id,postcode\r\n')
+            for row_id, postcode in enumerate(ALL_POSTCODES * 10, 1):
+                outfile.write('{:012d},"{}"\r\n'.format(row_id, postcode.replace(' ', '\r\n')))
+        self.addCleanup(os.remove, quoted)
+        for filename in [self.filename, quoted]:
+            expected = io.StringIO(newline='')
+            with open(filename) as infile:
+                ProcessFiles(infile, expected)
+            output = io.StringIO(newline='')
+            self.assertEqual(ProcessFilesInParallel(filename, output, workers=2),
+                             (len(ALL_POSTCODES) * 10, 140))
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+            batch = ValidateInParallel(filename, workers=2)
+            with open(filename) as infile:
+                reader = csv.reader(infile)
+                next(reader)
+                expected = PostCodeBatch(reader)
+            expected.Validate()
+            self.assertEqual(list(batch), list(expected))
+
+    def test_pipelined(self):
+        """
+        Output is exactly the same with reader and writer threads, errors
+        raised in either thread are raised in the caller and no thread is 
+        left running after an error in any of them
+        """
+        threads = threading.active_count()
+        expected = io.StringIO(newline='')
+        with open(self.filename) as infile:
+            ProcessFiles(infile, expected)
+        output = io.StringIO(newline='')
+        with open(self.filename) as infile, \
+             mock.patch('NHSTechnicalTestPart2.PIPELINE_BLOCK', 1000):
+            self.assertEqual(ProcessFilesPipelined(infile, output),
+                             (len(ALL_POSTCODES) * 10, 140))
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+        with open(self.filename) as infile, \
+             mock.patch.object(infile, 'read', side_effect=OSError('read')):
+            self.assertRaisesRegex(OSError, 'read', ProcessFilesPipelined, infile, io.StringIO())
+        with open(self.filename) as infile, \
+             mock.patch.object(BlockWriter, 'WriteRows', side_effect=OSError('write')):
+            self.assertRaisesRegex(OSError, 'write', ProcessFilesPipelined, infile, io.StringIO())
+        with open(self.filename) as infile, \
+             mock.patch('NHSTechnicalTestPart2.ValidateMany', side_effect=ValueError('validate')):
+            self.assertRaisesRegex(ValueError, 'validate', ProcessFilesPipelined, infile, io.StringIO())
+        self.assertEqual(threading.active_count(), threads)
+
+class PostCodeReaderTest(unittest.TestCase):
+    """
+    Tests of reading files with the memory mapped PostCodeReader
+    """
+    # Valid and invalid postcodes, CRLF and CR line endings, quoting (including
+    # a quoted newline), blank lines, odd numbers of fields, non-ASCII text and
+    # whitespace which str and bytes REs treat differently
+    TEXT = ('row_id,postcode\r\n1,M1 1AE\r\n2,"M1 1AE"\r\n3,"M1\r\n1AE"\r\n\r\n'
+            '4,M1 1AE\x1c\r\n5,M1 1AEé\n6,M1 1AE\xa0X\n7\n8,M1 1AE,x\n9,M1\x0c1AE\rM1 1AE\n'
+            '10,m1 1ae\n,GIR 0AA\n11,$%± ()()\n12,M1 1AE')
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w', newline='') as outfile:
+            outfile.write(self.TEXT)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_rows(self):
+        """
+        The rows and statuses are those of csv.reader and PostCode
+        """
+        with open(self.filename) as infile:
+            expected = [(row, PostCode(row[1]).status if len(row) > 1 else None) 
+                        for row in csv.reader(infile) if row][1:]
+        with PostCodeReader.Open(self.filename) as reader:
+            self.assertEqual(list(reader), expected)
+            self.assertEqual(reader.rows, len(expected))
+            self.assertEqual(reader.fast_rows, 4)
+        with PostCodeReader.Open(self.filename, valid=False) as reader:
+            fast = ('1', '4', '', '12')             # The rows LineRE matches
+            self.assertEqual(list(reader), [row for row in expected if row[0][0] not in fast])
+            self.assertEqual(reader.rows, len(expected))
+
+    def test_process(self):
+        """
+        Part 2's output is the same as with csv.DictReader
+        """
+        # Without the rows which don't have exactly two fields, which it can't cope with
+        with open(self.filename, 'w', newline='') as outfile:
+            outfile.write(self.TEXT.replace('7\n8,M1 1AE,x\n', '').replace('\rM1', '\r13,M1'))
+        expected = io.StringIO(newline='')
+        with open(self.filename) as infile:
+            rows = ProcessFiles(infile, expected)
+        output = io.StringIO(newline='')
+        with PostCodeReader.Open(self.filename, valid=False) as reader:
+            self.assertEqual(ProcessMappedFile(reader, output), rows)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_passthrough(self):
+        """
+        Lines are written exactly as they were read
+        """
+        output = io.StringIO(newline='')
+        with PostCodeReader.Open(self.filename, valid=False) as reader:
+            self.assertEqual(ProcessMappedFile(reader, output, passthrough=True), (14, 5))
+        self.assertEqual(output.getvalue(), 'row_id,postcode\r\n6,M1 1AE\xa0X\n7\nM1 1AE\n'
+                                            '10,m1 1ae\n11,$%± ()()\n')
+
+        # Every row, in a LineBatch, with a newline added to the last line
+        with open(self.filename) as infile:
+            expected = [PostCode(row[1]).status if len(row) > 1 else None
+                        for row in csv.reader(infile) if row][1:]
+        with PostCodeReader.Open(self.filename) as reader:
+            batch = reader.ReadLines()
+        self.assertEqual([status for row_id, line, status in batch], expected)
+        self.assertEqual(batch.RowId(2), 3)
+        output = io.StringIO(newline='')
+        batch.WriteCSV(output)
+        self.assertEqual(output.getvalue(), self.TEXT.replace('"\r\n\r\n', '"\r\n') + '\r\n')
+
+        # Which can be split and sorted like any other batch
+        successful, unsuccessful = SplitAndSortPostCodeList(batch)
+        self.assertEqual([line for row_id, line, status in unsuccessful],
+                         ['6,M1 1AE\xa0X\n', '7\n', '10,m1 1ae\n', '11,$%± ()()\n', 'M1 1AE\n'])
+        self.assertEqual(len(successful), 9)
+
+    def test_unsuitable(self):
+        """
+        Compressed files and files without a row_id,postcode header are left
+        to csv
+        """
+        with OpenOutput(self.filename, 'gzip') as outfile:
+            outfile.write(self.TEXT)
+        self.assertIsNone(PostCodeReader.Open(self.filename))
+        with open(self.filename, 'w') as outfile:
+            outfile.write('id,postcode\n1,M1 1AE\n')
+        self.assertIsNone(PostCodeReader.Open(self.filename))
+
+class BlockWriterTest(unittest.TestCase):
+    """
+    Tests of writing CSV rows a block at a time
+    """
+    def test_same_as_csv(self):
+        """
+        The output is the same as the csv writer's, whether or not a block
+        has to be quoted or has None row_ids in it
+        """
+        pairs = list(enumerate(ALL_POSTCODES, 1))
+        for extra in [[], [(None, 'M1 1AE')], [(7, 'M1,1AE')], [(8, 'M1 "1AE"')], 
+                      [(9, 'M1\n1AE')], [('None', '1AE')]]:
+            expected = io.StringIO(newline='')
+            csv.writer(expected).writerows([('row_id', 'postcode')] + pairs + extra + pairs)
+            output = io.StringIO(newline='')
+            writer = BlockWriter(output, batch_size=10)
+            writer.WriteHeader()
+            writer.WritePairs(pairs + extra + pairs)
+            self.assertEqual(output.getvalue(), expected.getvalue())
+            self.assertEqual(writer.rows, len(pairs) * 2 + len(extra))
+            self.assertEqual(writer.bytes, len(expected.getvalue().encode('utf-8')))
+
+    def test_bytes(self):
+        """
+        Bytes are counted in the file's encoding, ASCII or not
+        """
+        for encoding in ['utf-8', 'utf-16-le', 'latin-1']:
+            for text in ['1,M1 1AE\r\n', '24,$%± ()()\r\n']:
+                output = io.TextIOWrapper(io.BytesIO(), encoding=encoding, newline='')
+                writer = BlockWriter(output)
+                writer.WriteBlock(text * 3, 3)
+                output.flush()
+                self.assertEqual(writer.bytes, len(output.buffer.getvalue()), (encoding, text))
+
+    def test_dicts(self):
+        """
+        Rows written with Write() come out, once flushed, as csv.DictWriter's
+        """
+        rows = [{'row_id': str(i), 'postcode': p} for i, p in enumerate(ALL_POSTCODES)]
+        expected = io.StringIO(newline='')
+        writer = csv.DictWriter(expected, fieldnames=['row_id', 'postcode'])
+        writer.writeheader()
+        writer.writerows(rows)
+        output = io.StringIO(newline='')
+        writer = BlockWriter(output, fieldnames=['row_id', 'postcode'], batch_size=7)
+        writer.WriteHeader()
+        for row in rows:
+            writer.Write(row)
+        self.assertEqual(writer.rows, len(rows) // 7 * 7)
+        writer.Flush()
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+class CompressionTest(unittest.TestCase):
+    """
+    Tests of reading and writing compressed files
+    """
+    def test_round_trip(self):
+        """
+        Compressed files are detected by their contents, not their names, and
+        read back exactly as written
+        """
+        text = 'row_id,postcode\r\n1,$%± ()()\r\n2,M1 1AE\r\n'
+        handle, filename = tempfile.mkstemp()      # No suffix to go by
+        os.close(handle)
+        for compression in list(COMPRESSION) + [None]:
+            with OpenOutput(filename, compression) as outfile:
+                outfile.write(text)
+            self.assertEqual(DetectCompression(filename), compression)
+            with OpenInput(filename) as infile:     # Universal newlines, as open()
+                self.assertEqual(infile.read(), text.replace('\r\n', '\n'))
+        os.remove(filename)
+
+    def test_file_names(self):
+        self.assertEqual(CompressedFileName('failed.csv', 'gzip'), 'failed.csv.gz')
+        self.assertEqual(CompressedFileName('failed.csv.xz', 'xz'), 'failed.csv.xz')
+        self.assertEqual(CompressedFileName('failed.csv'), 'failed.csv')
+
+class CheckpointTest(unittest.TestCase):
+    """
+    Tests of resuming a run which died from its last checkpoint
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.directory.name, 'input.csv')
+        rng = random.Random(22)
+        row_ids = list(range(1, 3001))
+        rng.shuffle(row_ids)
+        with open(self.input, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['row_id', 'postcode'])
+            for row_id in row_ids:
+                writer.writerow([row_id, RandomInvalidPostCode(rng) if rng.random() < 0.2 
+                                         else RandomValidPostCode(rng)])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def File(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def Dies(self, module, calls=3):
+        """
+        Patches module's ValidateMany to die after calls blocks
+        """
+        def Validate(*args, **kwargs):
+            if not Validate.calls:
+                raise RuntimeError("Died")
+            Validate.calls -= 1
+            return ValidateMany(*args, **kwargs)
+        Validate.calls = calls
+        return mock.patch(module + '.ValidateMany', Validate)
+
+    def Read(self, name):
+        with open(self.File(name), 'rb') as infile:
+            return infile.read()
+
+    def test_part2(self):
+        self.assertTrue(PerformPart2(self.input, self.File('expected.csv')))
+        with self.Dies('NHSTechnicalTestPart2'), self.assertRaises(RuntimeError):
+            PerformPart2(self.input, self.File('failed.csv'), CheckpointRows=500)
+        self.assertNotEqual(self.Read('failed.csv'), self.Read('expected.csv'))
+        stats = PerformPart2(self.input, self.File('failed.csv'), Resume=True)
+        self.assertEqual(stats.info['resumed'], 1500)
+        self.assertEqual(self.Read('failed.csv'), self.Read('expected.csv'))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), 
+                         ['expected.csv', 'failed.csv', 'input.csv'])
+
+    def test_part3(self):
+        self.assertTrue(PerformPart3(self.input, self.File('matched.csv'), self.File('expected.csv')))
+        with self.Dies('NHSTechnicalTestPart3'), self.assertRaises(RuntimeError):
+            PerformPart3(self.input, self.File('ok.csv'), self.File('failed.csv'), CheckpointRows=500)
+        stats = PerformPart3(self.input, self.File('ok.csv'), self.File('failed.csv'), Resume=True)
+        self.assertEqual(stats.info['resumed'], 1500)
+        self.assertEqual(self.Read('ok.csv'), self.Read('matched.csv'))
+        self.assertEqual(self.Read('failed.csv'), self.Read('expected.csv'))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), 
+                         ['expected.csv', 'failed.csv', 'input.csv', 'matched.csv', 'ok.csv'])
+
+    def test_runs_synced(self):
+        """
+        Part 3's runs are on disk before a checkpoint records them
+        """
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            WriteRun([(1, 'M1 1AE')], self.directory.name)
+            self.assertEqual(fsync.call_count, 0)
+            WriteRun([(1, 'M1 1AE')], self.directory.name, sync=True)
+            self.assertEqual(fsync.call_count, 1)
+        with mock.patch('NHSTechnicalTestPart3.WriteRun', wraps=WriteRun) as write:
+            PerformPart3(self.input, self.File('ok.csv'), self.File('failed.csv'), CheckpointRows=500)
+        self.assertTrue(write.called)
+        self.assertTrue(all(call[0][2] for call in write.call_args_list))
+
+class FingerprintIndexTest(unittest.TestCase):
+    """
+    Tests of only validating the rows which have changed since the last run
+    """
+    def Run(self, rows, previous=None, block=300):
+        """
+        Validates rows through a FingerprintIndex a block at a time, checking
+        that the statuses are just what ValidateMany gives, and returns the index
+        """
+        index    = FingerprintIndex(previous)
+        statuses = []
+        for i in range(0, len(rows), block):
+            statuses.extend(index.Validate([row[0] for row in rows[i:i + block]], 
+                                           [row[1] for row in rows[i:i + block]]))
+        self.assertEqual(statuses, list(ValidateMany([row[1] for row in rows])))
+        self.assertEqual(index.reused + index.recomputed, len(rows))
+        return index
+
+    def test_delta(self):
+        rng  = random.Random(23)
+        rows = [[str(row_id), rng.choice(ALL_POSTCODES)] for row_id in range(1, 2001)]
+        first = self.Run(rows)
+        self.assertEqual(first.recomputed, 2000)
+        self.assertEqual(self.Run(rows, first).reused, 2000)
+        changed = [list(row) for row in rows]
+        for i in rng.sample(range(2000), 20):
+            changed[i][1] += 'X'                     # Always a different postcode
+        del changed[1500], changed[500]
+        changed.insert(700, ['5000', 'M1 1AE'])
+        changed.insert(10, ['', 'M1 1AE'])          # No row_id
+        changed.append(['6000', 'Q1 1AA'])
+        delta = self.Run(changed, first)
+        self.assertLessEqual(delta.recomputed, 23)
+        self.assertGreaterEqual(delta.recomputed, 21)   # Unless a changed row was deleted
+        rng.shuffle(changed)                        # Still right, if slower
+        self.Run(changed, first)
+        self.Run(changed, delta, block=1)
+
+    def test_save_and_load(self):
+        rows  = [[str(row_id), postcode] for row_id, postcode in enumerate(ALL_POSTCODES)]
+        index = self.Run(rows)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'index')
+            self.assertIsNone(FingerprintIndex.Load(filename))
+            index.Save(filename)
+            loaded = FingerprintIndex.Load(filename)
+            self.assertEqual((loaded.row_ids, loaded.hashes, loaded.statuses),
+                             (index.row_ids, index.hashes, index.statuses))
+            self.assertEqual(self.Run(rows, loaded).reused, len(rows))
+            self.Run(rows + [['99999999999999999999', 'M1 1AE']], loaded)   # Too big for the index
+            with mock.patch.object(FingerprintIndex, 'Version', return_value=0):
+                self.assertIsNone(FingerprintIndex.Load(filename))  # The REs have changed
+            with open(filename, 'r+b') as outfile:
+                outfile.truncate(30)
+            self.assertIsNone(FingerprintIndex.Load(filename))
+
+    def test_perform_tests(self):
+        """
+        Parts 2 and 3 give the same output with an index as without, whatever
+        the row_id column is called and however big its values
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            File  = lambda name: os.path.join(directory, name)
+            rng   = random.Random(5)
+            with open(File('input.csv'), 'w', newline='') as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(['id', 'postcode'])
+                writer.writerows((row_id, rng.choice(ALL_POSTCODES)) for row_id in range(1000, 0, -1))
+                writer.writerow([99999999999999999999, 'M1 1AE'])
+            for Perform, outputs, mode in [(PerformPart2, ['u.csv'], {}), 
+                                           (PerformPart2, ['u.csv'], {'Pipeline': True}),
+                                           (PerformPart3, ['m.csv', 'u.csv'], {})]:
+                expected = []
+                Perform(File('input.csv'), *map(File, outputs))
+                for name in outputs:
+                    with open(File(name)) as infile:
+                        expected.append(infile.read())
+                for reused in [0, 1001]:
+                    stats = Perform(File('input.csv'), *map(File, outputs), 
+                                    IndexFileName=File('index'), **mode)
+                    self.assertEqual(stats.info['reused'], reused)
+                    for name, text in zip(outputs, expected):
+                        with open(File(name)) as infile:
+                            self.assertEqual(infile.read(), text)
+                os.remove(File('index'))
+
+class GazetteerTest(unittest.TestCase):
+    """
+    Tests of checking valid postcodes against a reference list of those which exist
+    """
+    # Valid, but M0 has no postcodes and WC4 isn't a district at all
+    MISSING = ['M0 1AA', 'WC4 9PP', 'M1 1AF', 'CR2 6XJ']
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename  = os.path.join(self.directory.name, 'gazetteer.index')
+        reference = [p for p in ALL_POSTCODES if PostCode(p).status == PCValidationCodes.OK]
+        self.assertEqual(Gazetteer.Compile(reference + ['M1 1AE', 'JUNK'], self.filename), 10)
+        self.gazetteer = Gazetteer.Open(self.filename)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_exists(self):
+        for postcode in ['EC1A 1BB', 'M1 1AE', 'GIR 0AA', 'M1\t1AE', 'M1 1AEX', 'M1 1AE  ']:
+            self.assertTrue(self.gazetteer.Exists(postcode), postcode)
+        for postcode in self.MISSING:
+            self.assertFalse(self.gazetteer.Exists(postcode), postcode)
+
+    def test_check(self):
+        postcodes = ALL_POSTCODES + self.MISSING
+        statuses  = self.gazetteer.Check(postcodes, ValidateMany(postcodes))
+        expected  = list(ValidateMany(ALL_POSTCODES)) + [PCValidationCodes.NOT_FOUND.value] * 4
+        self.assertEqual(list(statuses), expected)
+        self.assertEqual((self.gazetteer.checked, self.gazetteer.missing), (14, 4))
+        # Block lookup gives the same answer as Exists for postcodes not in the usual form
+        postcodes = ['M1\t1AE', 'M1 1AEX', 'M1 1AE  ', 'M1 1AE9AA', 'M0 1AA ', 'WC4 9PPX']
+        statuses  = self.gazetteer.Check(postcodes, ValidateMany(postcodes))
+        self.assertEqual([status == PCValidationCodes.OK.value for status in statuses],
+                         list(map(self.gazetteer.Exists, postcodes)))
+
+    def test_open(self):
+        self.assertRaises(FileNotFoundError, Gazetteer.Open, self.filename + '.missing')
+        with open(self.filename, 'r+b') as outfile:
+            outfile.truncate(100)
+        self.assertRaisesRegex(ValueError, 'corrupt', Gazetteer.Open, self.filename)
+        with open(self.filename, 'wb') as outfile:
+            outfile.write(b'row_id,postcode\n')
+        self.assertRaisesRegex(ValueError, "isn't", Gazetteer.Open, self.filename)
+
+    def test_perform_tests(self):
+        """
+        Parts 2 and 3 fail the valid postcodes which aren't in the gazetteer
+        """
+        File = lambda name: os.path.join(self.directory.name, name)
+        rows = list(enumerate(ALL_POSTCODES + self.MISSING, 1))
+        with open(File('input.csv'), 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['row_id', 'postcode'])
+            writer.writerows(rows)
+        failed = [[str(row_id), postcode] for row_id, postcode in rows 
+                  if PostCode(postcode).status != PCValidationCodes.OK or postcode in self.MISSING]
+        for Perform, outputs in [(PerformPart2, ['u.csv']), (PerformPart3, ['m.csv', 'u.csv'])]:
+            stats = Perform(File('input.csv'), *map(File, outputs), GazetteerFileName=self.filename)
+            self.assertEqual(stats.info['not_found'], 4)
+            with open(File('u.csv'), newline='') as infile:
+                self.assertEqual(list(csv.reader(infile))[1:], failed)
+            self.assertFalse(Perform(File('input.csv'), *map(File, outputs), 
+                                     GazetteerFileName=File('input.csv')))
+
+class ImportTest(unittest.TestCase):
+    def test_no_logging_configured(self):
+        """
+        Importing NHSPostCode leaves the root logger alone
+        """
+        code = "import logging, NHSPostCode; print(len(logging.getLogger().handlers))"
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), '0')
+
+    def test_lazy_re(self):
+        """
+        A LazyRE is compiled when first looked up, and replaced by the compiled RE
+        """
+        class Base:
+            NumberRE = LazyRE(r'[0-9]+')
+        class Derived(Base):
+            pass
+        self.assertIsInstance(Base.__dict__['NumberRE'], LazyRE)
+        self.assertEqual(Derived().NumberRE.findall('a1b22'), ['1', '22'])
+        self.assertIs(Base.__dict__['NumberRE'], Base.NumberRE)
+        self.assertIsInstance(Base.NumberRE, type(re.compile('')))
+        self.assertNotIn('NumberRE', Derived.__dict__)
+
+class RunStatisticsTest(unittest.TestCase):
+    def test_stages(self):
+        """
+        Time spent in a nested stage is counted in that stage only, rows add
+        up and stages are reported in the order of RunStatistics.STAGES
+        """
+        stats = RunStatistics(input='import_data.csv')
+        self.assertFalse(stats)
+        stats.Add('validate', 1.5, 1.0, 7)
+        with stats.Stage('write', 2):
+            with stats.Stage('sort', 5) as stage:
+                sorted(range(100000), reverse=True)
+                stage['rows'] += 1
+        stats.success = True
+        self.assertTrue(stats)
+        result = json.loads(json.dumps(stats.Finish().AsDict()))
+        self.assertEqual(list(result['stages']), ['validate', 'sort', 'write'])
+        self.assertEqual([stage['rows'] for stage in result['stages'].values()], [7, 6, 2])
+        self.assertEqual(result['stages']['validate']['rows_per_second'], 7 / 1.5)
+        self.assertGreater(result['stages']['sort']['wall'], 0)
+        self.assertGreaterEqual(result['stages']['write']['wall'], 0)
+        self.assertLess(result['stages']['write']['wall'], result['stages']['sort']['wall'])
+        self.assertEqual(result['input'], 'import_data.csv')
+        self.assertTrue(result['success'])
+
+class ProfileTest(unittest.TestCase):
+    def Busy(self):
+        return sum(PostCode.Classify(p)[0].value for i in range(200) for p in ALL_POSTCODES)
+
+    def test_cprofile(self):
+        handle, filename = tempfile.mkstemp(suffix='.pstats')
+        os.close(handle)
+        self.assertEqual(RunProfiled(self.Busy, filename), self.Busy())
+        functions = [function for filename, line, function in pstats.Stats(filename).stats]
+        self.assertIn('Classify', functions)
+        os.remove(filename)
+
+    def test_sample(self):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        RunProfiled(lambda: [self.Busy() for i in range(20)], filename, sample=True)
+        with open(filename) as infile:
+            stacks = infile.read().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(any('NHSTechnicalTestPart1.py:Busy' in stack for stack in stacks))
+        os.remove(filename)
+
+class SyntheticDataTest(unittest.TestCase):
+    """
+    The synthetic postcodes generated by NHSBenchmarks fall in to the classes
+    they are meant to, whichever engine validates them
+    """
+    def test_failure_classes(self):
+        rng = random.Random(0)
+        for status in FAILURE_CLASSES:
+            for i in range(200):
+                postcode = RandomInvalidPostCode(rng, status)
+                self.assertEqual(PostCode(postcode, analyse=True).status, status, postcode)
+                for engine in PCValidationEngines:
+                    self.assertNotEqual(PostCode(postcode, engine=engine).status,
+                                        PCValidationCodes.OK, postcode)
+
+    def test_valid(self):
+        rng = random.Random(0)
+        for i in range(1000):
+            postcode = RandomValidPostCode(rng)
+            for engine in PCValidationEngines:
+                self.assertEqual(PostCode(postcode, engine=engine).status,
+                                 PCValidationCodes.OK, postcode)
+
 if __name__ == '__main__':
     
     unittest.main()
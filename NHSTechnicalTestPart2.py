@@ -26,13 +26,23 @@ failed_validation.csv with the same columns as above.
 
 import logging
 import sys
+import io
 import csv
 import argparse
+import concurrent.futures
+import queue
+import threading
+from itertools import compress, islice
 
-from NHSPostCode import PostCode, PCValidationCodes
+from NHSPostCode import PCValidationCodes, PCValidationEngines, ValidationCache, ValidateMany
+from NHSPostCode import FileChunks, ReadChunk, COMPRESSION, DetectCompression
+from NHSPostCode import OpenInput, OpenOutput, CompressedFileName, PostCodeReader
+from NHSPostCode import BlockWriter, OUTPUT_BUFFER_SIZE, RunStatistics, RunProfiled, Checkpoint
+from NHSPostCode import FingerprintIndex, Gazetteer
 
 
-def ProcessFiles(infile, errfile):
+def ProcessFiles(infile, errfile, engine=PCValidationEngines.REGEX, cache=None, header=True,
+                 stats=None, checkpoint=None, index=None, gazetteer=None):
     """
     Processes the records in infile and writes ones which don't 
     have postcodes which match the RE to errfile in the same 
@@ -41,6 +51,17 @@ def ProcessFiles(infile, errfile):
     Parameters:
         infile: Handle of input file (opened before call)
         errfile: Handle of error (unmatched) file (opened before call)
+        engine: PCValidationEngines value. How to match postcodes against the RE
+        cache: Optional ValidationCache through which to validate the postcodes
+        header: If False don't write the header line to errfile
+        stats: Optional NHSPostCode.RunStatistics to which to add the write stage
+        checkpoint: Optional NHSPostCode.Checkpoint to save every checkpoint.interval
+                    rows. If it has been loaded, carry on from where it got to 
+                    (with infile and errfile opened for that, see PerformTests)
+        index: Optional NHSPostCode.FingerprintIndex through which to validate the
+               rows, reusing the statuses of rows unchanged since the previous run
+        gazetteer: Optional NHSPostCode.Gazetteer in which to look up the valid 
+                   postcodes, failing those which don't exist
         
     Returns:
         rows: Total number of rows processed
@@ -51,20 +72,366 @@ def ProcessFiles(infile, errfile):
     # Create a dictionary reader which will read each line in to a 
     # dict keyed on field names. Then use the same fieldnames to drive
     # a dictwriter to output the errored records.
-    reader = csv.DictReader(infile)
-    writer = csv.DictWriter(errfile, fieldnames=reader.fieldnames)
-    writer.writeheader()   # Write the header line with the field names
-    for record in reader:  # Iterate through all input records
-        rows += 1
-        # If a postcode doesn't validate OK then write that row to the unmatched file
-        if PostCode(record['postcode']).status != PCValidationCodes.OK:
-            writer.writerow(record)
+    # The rows are written a block at a time (see NHSPostCode.BlockWriter).
+    size = BlockWriter.BATCH_SIZE
+    if checkpoint is None:
+        reader = csv.DictReader(infile)
+    else:
+        # Read through the checkpoint, so that it can record where we are.
+        # Resuming, the header has already been read (and written)
+        state  = checkpoint.state
+        reader = csv.DictReader(checkpoint.Lines(infile), fieldnames=state.get('fieldnames'))
+        rows   = state.get('rows', 0)
+        errs   = state.get('errs', 0)
+        header = header and not state
+        size   = min(size, checkpoint.interval)
+        due    = rows + checkpoint.interval
+    writer = BlockWriter(errfile, fieldnames=reader.fieldnames, batch_size=size)
+    if header:
+        writer.WriteHeader()   # Write the header line with the field names
+    # Read the records a block at a time and validate the whole block at once
+    # (see NHSPostCode.ValidateMany) rather than creating a PostCode for each.
+    # Then write the records whose postcodes don't validate OK to the unmatched file
+    failed = PCValidationCodes.OK.value.__ne__
+    block  = list(islice(reader, size))
+    while block:
+        postcodes = [record['postcode'] for record in block]
+        if index is None:
+            statuses = ValidateMany(postcodes, engine=engine, cache=cache)
+        else:
+            row_id   = reader.fieldnames[0]             # Whatever the first column is called
+            statuses = index.Validate([record[row_id] for record in block], postcodes, 
+                                      engine=engine, cache=cache)
+        if gazetteer is not None:
+            gazetteer.Check(postcodes, statuses)
+        errors   = list(compress(block, map(failed, statuses)))
+        writer.WriteRows(errors)
+        rows += len(block)
+        errs += len(errors)
+        if checkpoint is not None and rows >= due:
+            checkpoint.Save([errfile], rows=rows, errs=errs, fieldnames=reader.fieldnames)
+            due = rows + checkpoint.interval
+        block = list(islice(reader, size if checkpoint is None else min(size, due - rows)))
+    LogWriter(writer, errfile, stats)
+    return rows, errs
+
+
+# How many blocks of lines (of about PIPELINE_BLOCK characters) the reader thread
+# of ProcessFilesPipelined may read ahead, and how many blocks of errored rows
+# may wait for the writer thread
+
+PIPELINE_DEPTH = 4
+PIPELINE_BLOCK = 2**18
+
+
+def Put(blocks, item, stop):
+    """
+    Puts item on queue blocks, waiting until there is room unless (as the
+    thread at the other end has stopped) stop is set
+
+    Returns:
+        True if item was put on the queue, False if stop was set
+    """
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def Get(blocks, stop):
+    """
+    Returns the next item from queue blocks, waiting until there is one 
+    unless (as the thread at the other end has stopped) stop is set, when
+    it returns None
+    """
+    while not stop.is_set():
+        try:
+            return blocks.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def ReadBlocks(infile, blocks, stop):
+    """
+    Reader thread of ProcessFilesPipelined: puts lists of lines (about 
+    PIPELINE_BLOCK characters of them) read from infile on queue blocks and 
+    then None, or any exception raised reading them.
+
+    Each block is read with a single read (which readlines would make in 
+    many small ones) so that the thread only has to win the GIL back from 
+    the main thread once per block. A line split between blocks is carried 
+    over to the next.
+    """
+    try:
+        carried = ''
+        text    = infile.read(PIPELINE_BLOCK)
+        while text:
+            lines = io.StringIO(carried + text, newline='').readlines()
+            carried = '' if lines[-1].endswith('\n') else lines.pop()
+            if lines and not Put(blocks, lines, stop):
+                return
+            text = infile.read(PIPELINE_BLOCK)
+        if carried:
+            Put(blocks, [carried], stop)
+        Put(blocks, None, stop)
+    except Exception as error:
+        Put(blocks, error, stop)
+
+
+def WriteBlocks(writer, blocks, stop, errors):
+    """
+    Writer thread of ProcessFilesPipelined: writes each list of rows taken 
+    from queue blocks with BlockWriter writer until it takes None. Any 
+    exception raised writing them is added to the list errors and stop set.
+    """
+    try:
+        rows = Get(blocks, stop)
+        while rows is not None:
+            writer.WriteRows(rows)
+            rows = Get(blocks, stop)
+    except Exception as error:
+        errors.append(error)
+        stop.set()
+
+
+def ProcessFilesPipelined(infile, errfile, engine=PCValidationEngines.REGEX, cache=None,
+                          stats=None, index=None, gazetteer=None):
+    """
+    Does the same as ProcessFiles, to the same output, but with the input read
+    by a reader thread and the errored rows written by a writer thread, so 
+    that reading and writing overlap with validating, which is all the main
+    thread does.
+
+    Parameters:
+        infile: Handle of input file (opened before call)
+        errfile: Handle of error (unmatched) file (opened before call)
+        engine: PCValidationEngines value. How to match postcodes against the RE
+        cache: Optional ValidationCache through which to validate the postcodes
+        stats: Optional NHSPostCode.RunStatistics to which to add the rows 
+               written, as the write stage. Its time, which overlaps, is 
+               counted in the stage ProcessFilesPipelined is called in.
+        index: Optional NHSPostCode.FingerprintIndex through which to validate
+        gazetteer: Optional NHSPostCode.Gazetteer in which to look up the valid postcodes
+        
+    Returns:
+        rows: Total number of rows processed
+        errs: Total number of errored/malformed rows
+
+    Notes:
+        The threads pass blocks of lines and rows through queues of at most
+        PIPELINE_DEPTH blocks, so memory use is bounded however far ahead 
+        the reader gets. Only one thread can run Python code at a time (the
+        GIL) but reading and writing a file releases it while waiting on the
+        disk or network, so on slow storage (e.g. an NFS share) that waiting
+        happens while the main thread validates rather than after. Where the
+        files are in the page cache there is no waiting to hide and the 
+        threads only add a little overhead.
+    """
+    stop    = threading.Event()
+    lines   = queue.Queue(PIPELINE_DEPTH)
+    output  = queue.Queue(PIPELINE_DEPTH)
+    errors  = []                                    # Raised by the writer thread
+    reader  = threading.Thread(target=ReadBlocks, args=(infile, lines, stop), daemon=True)
+
+    def Lines():
+        block = Get(lines, stop)
+        while block is not None:
+            if isinstance(block, Exception):
+                raise block
+            yield from block
+            block = Get(lines, stop)
+
+    rows   = 0
+    errs   = 0
+    thread = None                                   # The writer, once started
+    reader.start()
+    try:
+        records = csv.DictReader(Lines())
+        writer  = BlockWriter(errfile, fieldnames=records.fieldnames)
+        writer.WriteHeader()
+        thread  = threading.Thread(target=WriteBlocks, args=(writer, output, stop, errors), 
+                                   daemon=True)
+        thread.start()
+        failed = PCValidationCodes.OK.value.__ne__
+        block  = list(islice(records, writer.batch_size))
+        while block:
+            postcodes = [record['postcode'] for record in block]
+            if index is None:
+                statuses = ValidateMany(postcodes, engine=engine, cache=cache)
+            else:
+                row_id   = records.fieldnames[0]        # Whatever the first column is called
+                statuses = index.Validate([record[row_id] for record in block], postcodes, 
+                                          engine=engine, cache=cache)
+            if gazetteer is not None:
+                gazetteer.Check(postcodes, statuses)
+            failures = list(compress(block, map(failed, statuses)))
+            if not Put(output, failures, stop):
+                break                               # The writer thread has failed
+            rows += len(block)
+            errs += len(failures)
+            block = list(islice(records, writer.batch_size))
+        Put(output, None, stop)
+        thread.join()
+    finally:
+        stop.set()                                  # Stop the threads, if they haven't,
+        if thread is not None:                      # and wait for them, so none outlives
+            thread.join()                           # the call (or its files)
+        reader.join()
+    if errors:
+        raise errors[0]
+    LogWriter(writer, errfile)
+    if stats is not None:
+        stats.Add('write', 0.0, 0.0, writer.rows)
+    return rows, errs
+
+
+def LogWriter(writer, errfile, stats=None):
+    """
+    Logs the BlockWriter statistics for errfile, unless it isn't a file
+    with a name (e.g. the io.StringIO of ProcessChunk), and adds them to
+    stats (a NHSPostCode.RunStatistics), if given, as the write stage
+    """
+    name = getattr(errfile, 'name', None)
+    if isinstance(name, str):
+        writer.LogStatistics(name)
+    if stats is not None:
+        stats.Add('write', writer.seconds, writer.cpu, writer.rows)
+
+
+def ProcessMappedFile(reader, errfile, header=True, passthrough=False, stats=None):
+    """
+    Does the same as ProcessFiles, to the same output, but reads the input
+    with a NHSPostCode.PostCodeReader, which only hands us the rows whose
+    postcodes don't validate.
+    
+    Parameters:
+        reader: PostCodeReader opened with valid=False (and the engine and
+                cache to validate with)
+        errfile: Handle of error (unmatched) file (opened before call)
+        header: If False don't write the header line to errfile
+        passthrough: If True write the header and rows exactly as they are in
+                     the input (e.g. with the same quoting and newlines) rather
+                     than formatting them again
+        stats: Optional NHSPostCode.RunStatistics to which to add the write stage
+        
+    Returns:
+        rows: Total number of rows processed
+        errs: Total number of errored/malformed rows
+    """
+    if passthrough:
+        writer = BlockWriter(errfile)
+        if header:
+            writer.WriteBlock(reader.Header())
+        writer.WriteLines(reader.Line() for row, status in reader 
+                          if status is not PCValidationCodes.OK)
+        LogWriter(writer, errfile, stats)
+        return reader.rows, writer.rows
+    errs = 0
+    fieldnames = reader.fieldnames
+    writer = BlockWriter(errfile, fieldnames=fieldnames)
+    if header:
+        writer.WriteHeader()
+    for row, status in reader:
+        if status is not PCValidationCodes.OK:
+            record = dict(zip(fieldnames, row))     # As csv.DictReader would have it
+            if len(row) > len(fieldnames):
+                record[None] = row[len(fieldnames):]
+            writer.Write(record)
             errs += 1
+    writer.Flush()
+    LogWriter(writer, errfile, stats)
+    logging.info("{:,} of {:,} rows matched without being decoded".format(reader.fast_rows, reader.rows))
+    return reader.rows, errs
+
+
+def ProcessChunk(filename, header, start, end, engine=PCValidationEngines.REGEX, cache_size=0):
+    """
+    Processes the records in one chunk of the input file (see 
+    NHSPostCode.FileChunks) as ProcessFiles does. Run in a worker process.
+    
+    Parameters:
+        filename:   Name of the input file
+        header:     The input file's header line (bytes)
+        start, end: Byte offsets of the chunk in the file
+        engine:     PCValidationEngines value. How to match postcodes against the RE
+        cache_size: If non-zero, validate through a ValidationCache of this many entries
+        
+    Returns:
+        rows: Number of rows processed
+        errs: Number of errored/malformed rows
+        text: The errored rows, exactly as ProcessFiles would have written them
+              (but without the header line)
+    """
+    errfile = io.StringIO(newline='')
+    cache   = ValidationCache(cache_size) if cache_size else None
+    rows, errs = ProcessFiles(ReadChunk(filename, start, end, header), errfile, 
+                              engine, cache, header=False)
+    return rows, errs, errfile.getvalue()
+
+
+def ProcessFilesInParallel(filename, errfile, engine=PCValidationEngines.REGEX, 
+                           cache_size=0, workers=2, stats=None):
+    """
+    Does the same as ProcessFiles, to the same output, but splits the input
+    file in to chunks which are processed by a pool of worker processes.
+    
+    Parameters:
+        filename:   Name of the input file
+        errfile:    Handle of error (unmatched) file (opened before call)
+        engine:     PCValidationEngines value. How to match postcodes against the RE
+        cache_size: If non-zero, each worker validates through its own 
+                    ValidationCache of this many entries
+        workers:    Number of worker processes
+        stats:      Optional NHSPostCode.RunStatistics to which to add the write stage
+        
+    Returns:
+        rows: Total number of rows processed
+        errs: Total number of errored/malformed rows
+
+    Notes:
+        The file is split in to several chunks per worker so that a worker which
+        finishes early can pick up another chunk. The workers send back the
+        text of their errored rows, which we write out in chunk order, so the
+        output is byte for byte the same as that of ProcessFiles.
+    """
+    header, chunks = FileChunks(filename, workers * 4)
+    with open(filename) as infile:                  # Write the header as ProcessFiles does
+        writer = BlockWriter(errfile, fieldnames=csv.DictReader(infile).fieldnames)
+    writer.WriteHeader()
+    rows = 0
+    errs = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(ProcessChunk, filename, header, start, end, engine, cache_size)
+                   for start, end in chunks]
+        for future in futures:                      # In chunk order
+            chunk_rows, chunk_errs, text = future.result()
+            rows += chunk_rows
+            errs += chunk_errs
+            writer.WriteBlock(text, chunk_errs)
+    logging.info("Processed {:,} chunks in {} worker processes".format(len(chunks), workers))
+    LogWriter(writer, errfile, stats)
     return rows, errs
 
     
 def PerformTests(InputFileName     = 'import_data.csv',
-                 UnmatchedFileName = 'failed_validation.csv'):
+                 UnmatchedFileName = 'failed_validation.csv',
+                 Engine            = PCValidationEngines.REGEX,
+                 CacheSize         = 0,
+                 Workers           = 1,
+                 Compression       = None,
+                 Mmap              = False,
+                 BufferSize        = OUTPUT_BUFFER_SIZE,
+                 PassThrough       = False,
+                 Metrics           = None,
+                 CheckpointRows    = 0,
+                 Resume            = False,
+                 IndexFileName     = None,
+                 Pipeline          = False,
+                 GazetteerFileName = None):
     """
     Performs the part 2 tests
     
@@ -72,28 +439,145 @@ def PerformTests(InputFileName     = 'import_data.csv',
         
         InputFileName: Name of the input CSV file from which the postcodes are read
         ErrorFileName: Name of the file to which to write invalid postcode records
+        Engine:        PCValidationEngines value. How to match postcodes against the RE
+        CacheSize:     If non-zero, validate through a ValidationCache of this many
+                       entries (repeated postcodes are then only validated once)
+        Workers:       If more than 1, validate the file in chunks in this many
+                       worker processes (see ProcessFilesInParallel)
+        Compression:   If given, one of NHSPostCode.COMPRESSION ('gzip', 'bz2' or
+                       'xz') with which to compress the output file. Its usual
+                       suffix (e.g. .gz) is added to ErrorFileName.
+        Mmap:          If True read the input with a NHSPostCode.PostCodeReader 
+                       (see ProcessMappedFile), unless the file is compressed or
+                       isn't a row_id,postcode file. Workers takes precedence.
+        BufferSize:    Size of the output file's buffer in bytes
+        PassThrough:   If True write each errored row exactly as it was read (e.g.
+                       with the same quoting and newlines) rather than formatting
+                       it again. Implies Mmap.
+        Metrics:       If given, the name of a file to which to write the run's
+                       statistics (see NHSPostCode.RunStatistics) as JSON
+        CheckpointRows: If non-zero, checkpoint the run every this many rows to
+                       ErrorFileName with .checkpoint added (see NHSPostCode.Checkpoint),
+                       so that it can be resumed if it dies. Not for compressed 
+                       output. Workers, Mmap and PassThrough are ignored.
+        Resume:        If True carry on from the checkpoint of an earlier run, if 
+                       there is one, to the same output as if it hadn't stopped. 
+                       Implies CheckpointRows (by default every 1M rows).
+        IndexFileName: If given, only validate the rows which are new or have changed
+                       since the run which wrote this NHSPostCode.FingerprintIndex,
+                       reusing the status of the rest, and then write the index of 
+                       this run's input to it. Workers, Mmap and PassThrough are 
+                       ignored.
+        Pipeline:      If True read the input and write the output in threads of 
+                       their own, overlapping with validation (see 
+                       ProcessFilesPipelined), for input and output on slow storage.
+                       Workers and Mmap take precedence and it can't be checkpointed.
+        GazetteerFileName: If given, a gazetteer index (see NHSPostCode.Gazetteer)
+                       of the postcodes which exist. Valid postcodes which aren't
+                       in it fail too (as PCValidationCodes.NOT_FOUND). Workers,
+                       Mmap and PassThrough are ignored.
+                       
+        The input file may be compressed with any of NHSPostCode.COMPRESSION, 
+        in which case it is decompressed as it is read (see NHSPostCode.OpenInput).
         
     Returns:
         
-        Success: Boolean. True if exectuted successfully else False
+        Success: NHSPostCode.RunStatistics of the run, with the time, rows and
+                 peak memory of the validate and write stages (validate 
+                 includes reading, as each row is validated as it's read). 
+                 True if exectuted successfully else False
     """
     # Open the input and output files and then process their contents.
     # Note that as of Python 3.x we need the "newline=''"
     # in the open statement to suppress printing blank lines in the 
     # CSV file if we run this under Windows.
 
+    UnmatchedFileName = CompressedFileName(UnmatchedFileName, Compression)
+    stats = RunStatistics(input=InputFileName, output=UnmatchedFileName)
+    checkpoint = None
+    position   = None                               # Where to resume writing the output
+    if (CheckpointRows or Resume) and Compression:
+        logging.warning("Can't resume writing compressed output, so not checkpointing")
+    elif CheckpointRows or Resume:
+        checkpoint = Checkpoint(UnmatchedFileName + '.checkpoint', InputFileName, 
+                                CheckpointRows or Checkpoint.INTERVAL)
+    index = None
+    if IndexFileName:
+        index = FingerprintIndex(FingerprintIndex.Load(IndexFileName))
+    gazetteer = None
+    if GazetteerFileName:
+        try:
+            gazetteer = Gazetteer.Open(GazetteerFileName)
+        except (OSError, ValueError) as error:
+            logging.error("Can't use gazetteer {}: {}".format(GazetteerFileName, error))
+            return stats.Finish(Metrics)
+    single = checkpoint or index is not None or gazetteer is not None
+    if single and (Workers > 1 or Mmap or PassThrough):
+        logging.warning("Checkpointing or using an index or gazetteer, so reading the input "
+                        "in a single process with csv")
+        Workers, Mmap, PassThrough = 1, False, False
+    if checkpoint and Pipeline:
+        logging.warning("Can't checkpoint reading and writing in threads, so not pipelining")
+        Pipeline = False
+
     # Try opening the input file, handling any plausible exceptions
     try:   
         logging.info("Opening {} for reading".format(InputFileName))
-        with open(InputFileName) as infile: 
+        with OpenInput(InputFileName) as infile: 
+            if Resume and checkpoint and checkpoint.Load([UnmatchedFileName]):
+                position = checkpoint.state['outputs'][0]
+                stats.info.update(resumed=checkpoint.state['rows'])
+            if Workers > 1 and DetectCompression(InputFileName):
+                logging.warning("Can't split compressed input in to chunks, so using a single process")
+                Workers = 1
         # With the input sucesfully openend, try opening the output and handle exceptions                               
             try: 
                 logging.info("Opening {} for writing ".format(UnmatchedFileName))
-                with open(UnmatchedFileName, 'w', newline = '') as errfile:
-                    rows, errs = ProcessFiles(infile, errfile) # Process the two files
+                with OpenOutput(UnmatchedFileName, Compression, BufferSize, position) as errfile:
+                    cache = ValidationCache(CacheSize) if CacheSize and Workers <= 1 else None
+                    reader = None
+                    if (Mmap or PassThrough) and Workers <= 1:
+                        reader = PostCodeReader.Open(InputFileName, engine=Engine, 
+                                                     cache=cache, valid=False)
+                        if PassThrough and not reader:
+                            logging.warning("Can't pass {} through, so formatting the rows again"
+                                            .format(InputFileName))
+                    with stats.Stage('validate') as stage:
+                        if Workers > 1:
+                            rows, errs = ProcessFilesInParallel(InputFileName, errfile, Engine, 
+                                                                CacheSize, Workers, stats)
+                        elif reader:
+                            with reader:
+                                rows, errs = ProcessMappedFile(reader, errfile, stats=stats,
+                                                               passthrough=PassThrough)
+                        elif Pipeline:
+                            rows, errs = ProcessFilesPipelined(infile, errfile, Engine, cache, 
+                                                               stats, index, gazetteer)
+                        else:                       # Process the two files
+                            rows, errs = ProcessFiles(infile, errfile, Engine, cache, stats=stats,
+                                                      checkpoint=checkpoint, index=index,
+                                                      gazetteer=gazetteer)
+                        stage['rows'] += rows - stats.info.get('resumed', 0)
+                    stats.info.update(rows=rows, errors=errs)
                     logging.info('Read {:,} rows from {}. Wrote {:,} errored rows ({:.1%}).'\
                                  .format(rows, InputFileName, errs, errs/rows))
-                    return True # Completed successfully
+                    if cache:
+                        cache.LogStatistics()
+                    if gazetteer is not None:
+                        gazetteer.LogStatistics()
+                        stats.info.update(not_found=gazetteer.missing)
+                    if index is not None:
+                        index.LogStatistics()
+                        stats.info.update(reused=index.reused, recomputed=index.recomputed)
+                        if 'resumed' in stats.info:
+                            logging.warning("Resumed part way through, so not writing {}"
+                                            .format(IndexFileName))
+                        else:
+                            index.Save(IndexFileName)
+                    if checkpoint:
+                        checkpoint.Remove()
+                    stats.success = True # Completed successfully
+                    return stats.Finish(Metrics)
             except (PermissionError, FileNotFoundError):
                 # PermissionError usually means we are trying to write to a directory
                 # or overwrite a file where we don't have appropriate permissions.
@@ -104,7 +588,7 @@ def PerformTests(InputFileName     = 'import_data.csv',
         logging.error("Can't find file {}".format(InputFileName))
     except IOError:           # Usually caused if the file is already open elsewhere
         logging.error("Can't open file {} for reading".format(InputFileName))
-    return False
+    return stats.Finish(Metrics)
     
 
 def ParseArguments():
@@ -113,11 +597,62 @@ def ParseArguments():
     """
     parser = argparse.ArgumentParser(description="Perform Part 2 NHS Digital Technical Tests")
     parser.add_argument("--input",   
-                        help="Input postcode data", 
+                        help="Input postcode data (which may be gzip, bz2 or xz compressed)", 
                         default="import_data.csv")
     parser.add_argument("--unmatched",   
                         help="Output unmatched/invalid data", 
                         default="failed_validation.csv")
+    parser.add_argument("--engine",
+                        help="How to match postcodes against the RE",
+                        choices=[e.name.lower() for e in PCValidationEngines],
+                        default="regex")
+    parser.add_argument("--cache-size",
+                        help="Size of the validation cache (0 for no cache)",
+                        type=int, default=0)
+    parser.add_argument("--workers",
+                        help="Number of worker processes to validate with",
+                        type=int, default=1)
+    parser.add_argument("--compress",
+                        help="Compress the output file",
+                        choices=sorted(COMPRESSION), default=None)
+    parser.add_argument("--mmap",
+                        help="Read the input with the memory mapped PostCodeReader",
+                        action="store_true")
+    parser.add_argument("--buffer-size",
+                        help="Size of the output file's buffer in bytes",
+                        type=int, default=OUTPUT_BUFFER_SIZE)
+    parser.add_argument("--passthrough",
+                        help="Write each errored row exactly as it was read",
+                        action="store_true")
+    parser.add_argument("--metrics",
+                        help="Write the run's statistics to this file as JSON",
+                        default=None)
+    parser.add_argument("--profile",
+                        help="Profile the run, writing the profile to this file",
+                        default=None)
+    parser.add_argument("--profile-sample",
+                        help="Profile by sampling the stack (lower overhead) rather than with cProfile",
+                        action="store_true")
+    parser.add_argument("--profile-top",
+                        help="Number of functions to list in the profile summary",
+                        type=int, default=20)
+    parser.add_argument("--checkpoint",
+                        help="Checkpoint the run every this many rows, so that it can be resumed",
+                        type=int, default=0)
+    parser.add_argument("--resume",
+                        help="Resume from the checkpoint of a run which didn't finish",
+                        action="store_true")
+    parser.add_argument("--index",
+                        help="Only validate rows changed since the run which wrote this index, "
+                             "then write this run's index to it",
+                        default=None)
+    parser.add_argument("--pipeline",
+                        help="Read and write in background threads, overlapping with validation",
+                        action="store_true")
+    parser.add_argument("--gazetteer",
+                        help="Also fail valid postcodes which aren't in this gazetteer index "
+                             "(see NHSPostCode.py)",
+                        default=None)
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -128,11 +663,43 @@ if __name__ == '__main__':
     Command line arguments:
         --input:       Input file name
         --unmtached:   Output file name for unmatched
+        --engine:      Validation engine (regex, table or single_match)
+        --cache-size:  Size of the validation cache
+        --workers:     Number of worker processes
+        --compress:    Compress the output (gzip, bz2 or xz)
+        --mmap:        Read the input with PostCodeReader
+        --buffer-size: Size of the output file's buffer
+        --passthrough: Write each errored row exactly as it was read
+        --metrics:     File to which to write the run's statistics as JSON
+        --profile:     File to which to write a profile of the run
+        --profile-sample: Profile by sampling the stack rather than with cProfile
+        --profile-top: Number of functions to list in the profile summary
+        --checkpoint:  Number of rows between checkpoints
+        --resume:      Resume from the last checkpoint
+        --index:       Fingerprint index of the previous run's input
+        --pipeline:    Read and write in background threads
+        --gazetteer:   Gazetteer index of the postcodes which exist
     """
     args = ParseArguments()
     logging.basicConfig(stream = sys.stdout, level = logging.DEBUG, 
                 format = '%(asctime)s:%(levelname)s:%(message)s')
 
-    PerformTests(InputFileName     = args.input,
-                 UnmatchedFileName = args.unmatched)
-
+    Run = lambda: PerformTests(InputFileName     = args.input,
+                               UnmatchedFileName = args.unmatched,
+                               Engine            = PCValidationEngines[args.engine.upper()],
+                               CacheSize         = args.cache_size,
+                               Workers           = args.workers,
+                               Compression       = args.compress,
+                               Mmap              = args.mmap,
+                               BufferSize        = args.buffer_size,
+                               PassThrough       = args.passthrough,
+                               Metrics           = args.metrics,
+                               CheckpointRows    = args.checkpoint,
+                               Resume            = args.resume,
+                               IndexFileName     = args.index,
+                               Pipeline          = args.pipeline,
+                               GazetteerFileName = args.gazetteer)
+    if args.profile:
+        RunProfiled(Run, args.profile, args.profile_sample, args.profile_top)
+    else:
+        Run()